@@ -25,9 +25,13 @@
 # Mark Troyer <disco@blackops.io>
 
 import argparse
-import dateutil.parser
+from database import mark_finished
+import github_data
 from migration_helper import MigrationHelper
+from progress import ApiCounter, Progress, peak_memory
+import scheduler
 import sys
+import time
 from time import sleep
 import warnings
 
@@ -46,15 +50,16 @@ def migrate_branch_protection(mh, repo_id, ghe_user, gh_repo):
 
     user_id = mh.get_local_userid(ghe_user)
     already_protected = mh.get_protected_branches(repo_id)
-    for branch in gh_repo.branches():
-        if branch.name in already_protected:
-            continue
-        if branch.protected:
-            print "Branch: {}".format(branch.name)
-            mh.set_branch_protection(repo_id, user_id, branch)
+    with mh.unit_of_work() as uow:
+        for name, protection in github_data.branch_protections(gh_repo):
+            if name in already_protected:
+                continue
+            print "Branch: {}".format(name)
+            uow.run(mh.set_branch_protection, repo_id, user_id, name, protection)
+            uow.checkpoint()
 
 
-def migrate_reviews(mh, repo_id, gh_repo):
+def migrate_reviews(mh, repo_id, gh_repo, api=None, first=None, last=None, checkpoint=None):
     """
     Migrate all pull request reviews for a given repository from github.com
     to GitHub Enterprise
@@ -62,79 +67,246 @@ def migrate_reviews(mh, repo_id, gh_repo):
     Arguments:
         repo_id (int): The local id of the migrated repository
         gh_repo (object): GitHub repository object
+        api (ApiCounter): Counter for the API calls being made
+        first (int): Only migrate pull requests numbered from this one
+        last (int): Only migrate pull requests numbered up to this one
+        checkpoint (function): Called before each pull request. Raising
+            from it rolls back any reviews that haven't been committed.
     """
+    prs = [pr for pr in mh.get_migrated_prs(repo_id)
+           if (first is None or pr.number >= first) and (last is None or pr.number <= last)]
     # The API has a habit of returning a blank response and stopping
     # the migration process, so we'll check for already migrated
-    # reviews and pick up where we left off
-    last_reviewed_pr = mh.get_last_migrated_review(repo_id)
-
-    for pr in mh.get_migrated_prs(repo_id):
-        if pr['number'] <= last_reviewed_pr:
-            print "- Pull request {} (id: {}) ...Already migrated, skipping".format(pr['number'], pr['id'])
-            continue
-
-        sys.stdout.write("- Pull request {} (id: {}) ".format(pr['number'], pr['id']))
-        sys.stdout.flush()
-
-        # Get the github.com version of the pull request
-        gh_pr = gh_repo.pull_request(pr['number'])
-
-        # Get all reviews attached to the pull request and extract the
-        # data we need for the migration
-        reviews = {}
-        for rev in gh_pr.reviews():
-            formatter = 'NULL'
-            if len(rev.body) > 0:
-                formatter = "'markdown'"
-            reviews[rev.id] = {
-                'pull_request_id': pr['id'],
-                'user_id': mh._get_user_id(rev.user.login),
-                'state': mh.review_states[rev.state],
-                'head_sha': rev.commit_id,
-                'body': rev.body,
-                'submitted_at': dateutil.parser.parse(rev.submitted_at, ignoretz=True),
-                'formatter': formatter,
-                'comment_id': []
-            }
-        if len(reviews) == 0:
-            print "...No reviews"
-            sleep(1)
-            continue
-
-        # Get any review comment records that go with the pull request
-        for com in gh_pr.review_comments():
-            # This is a little fudge factor for testing the migration.
-            # During the final migration the repositories on github.com
-            # should be locked, so no updates will take place. During
-            # testing the repositories won't be locked so you can easily
-            # run into the situation where a comment will be added after
-            # the migration archive was created and so there won't be a
-            # local id for it.
-            if com.pull_request_review_id:
-                try:
-                    reviews[com.pull_request_review_id]['comment_id'].append(mh.get_local_comment_id(com.id))
-                except TypeError:
-                    continue
-
-        # Now that we have all the reviews and associated comments
-        # we add the reviews to the pull_request_reviews table and
-        # associated the comments with them.
-        for r in reviews:
-            mh.add_review(pr['number'], reviews[r], gh_pr)
-
-            sys.stdout.write(".")
-            sys.stdout.flush()
-        print " Done"
-        sleep(2)
+    # reviews and skip those pull requests. Checking each one rather
+    # than resuming after the last one means a range can be worked on by
+    # itself, and a pull request missed in the middle gets picked up.
+    reviewed_prs = mh.get_reviewed_prs(repo_id, first or 0, last or 2 ** 31)
+
+    progress = Progress('pull requests', total=len(prs), api=api)
+    skipped = 0
+    reviewed = 0
+    # Reviews are committed in batches, but only ever between pull
+    # requests so a restart never finds a pull request with only some of
+    # its reviews migrated.
+    with mh.unit_of_work() as uow:
+        for pr in prs:
+            progress.update()
+            if checkpoint:
+                checkpoint()
+            if pr.number in reviewed_prs:
+                skipped += 1
+                continue
+
+            # Get the github.com version of the pull request
+            gh_pr = gh_repo.pull_request(pr.number)
+
+            # Get all reviews attached to the pull request, along with the
+            # review comments that go with them
+            reviews = github_data.pr_reviews(gh_pr)
+            if len(reviews) == 0:
+                sleep(1)
+                continue
+
+            # Dismissed reviews need the dismissal events from the timeline
+            dismissals = None
+            if any(r.state == 'DISMISSED' for r in reviews):
+                dismissals = github_data.review_dismissals(gh_pr)
+
+            # Now that we have all the reviews and associated comments
+            # we add the reviews to the pull_request_reviews table and
+            # associated the comments with them. Another worker whose
+            # lease on this range ran out may have got here first, which
+            # migrate_pr_reviews checks for, again if it's retried.
+            added = uow.run(mh.migrate_pr_reviews, pr, reviews, dismissals)
+            if added:
+                reviewed += added
+            else:
+                skipped += 1
+            uow.checkpoint()
+            sleep(2)
+
+    progress.finish("{} reviews migrated, {} pull requests already migrated".format(reviewed, skipped))
 
     # Now that all the reviews have been migrated and the comments
     # associated, we need to set the state for the comments from
     # pending to active.
     mh.set_comments_active(repo_id)
-    # Reset the repository pushed_at time back to what github.com
-    # says it is to maintain a semblance of the order you see the
-    # listing in there.
-    mh.set_repo_pushed(repo_id, gh_repo.pushed_at.replace(tzinfo=None))
+
+
+def work_estimates(mh, args):
+    """
+    Get the work estimates for the repositories to migrate, limited to
+    the ones given with --only if there are any.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        args (argparse.Namespace): Parsed command line arguments
+    Returns:
+        (list): The estimates, see MigrationHelper.get_repo_work_estimates
+    """
+    only = set(name for name in getattr(args, 'only', '').split(',') if name)
+    return [r for r in mh.get_repo_work_estimates() if not only or r['name'] in only]
+
+
+def run(mh, args):
+    """
+    Complete the migration of every repository: branch protections,
+    reviews and repository settings.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        args (argparse.Namespace): Parsed command line arguments, for the
+            local user and the scheduling options
+    """
+    sched = scheduler.Scheduler(
+        work_estimates(mh, args),
+        args.order,
+        [name for name in args.critical.split(',') if name]
+    )
+    # Set the wiki and issues options and reset the pushed_at time back
+    # to what github.com says it is (to maintain a semblance of the order
+    # you see the listing in there) for every repository at once.
+    api = ApiCounter.for_session(mh.gh)
+    print "Syncing repository settings for {}".format(mh.org)
+    gh_repos = mh.sync_repo_metadata()
+
+    remaining, reset = scheduler.rate_limit(mh.gh)
+    print sched.report(remaining, reset)
+
+    while True:
+        i = sched.next_repo(remaining)
+        if i is None:
+            break
+
+        # If this repository won't fit in what's left of the budget but
+        # would fit in a fresh one, wait for the reset rather than running
+        # out halfway through.
+        if remaining < sched.estimate(i) <= scheduler.RATE_LIMIT:
+            print "Waiting until {} for the API rate limit to reset".format(time.strftime('%H:%M', time.localtime(reset)))
+            sleep(max(0, reset - time.time()) + 5)
+            remaining, reset = scheduler.rate_limit(mh.gh)
+        before = remaining
+        started = time.time()
+
+        # Get the github.com version of the repo as an object
+        gh_repo = gh_repos.get(i['name']) or mh.gh.repository(mh.org, i['name'])
+
+        print "Migrating branch protection settings for {}".format(i['name'])
+        migrate_branch_protection(mh, i['id'], args.ghe_user, gh_repo)
+
+        print "Migrating reviews for repo {}".format(i['name'])
+        migrate_reviews(mh, i['id'], gh_repo, api)
+
+        remaining, reset = scheduler.rate_limit(mh.gh)
+        # A reset in the middle of the repository makes the difference
+        # meaningless, so fall back to the estimate.
+        calls = before - remaining if before >= remaining else sched.estimate(i)
+        sched.finish(i, calls, time.time() - started)
+        print sched.report(remaining, reset)
+
+    print mh.users.stats()
+    print peak_memory()
+
+
+# Wait for the rate limit to reset rather than start an item with fewer
+# calls than this left
+MIN_CALLS = 100
+
+
+def enqueue(mh, queue, args):
+    """
+    Sync the repository settings and queue up the branch protection and
+    review work for every repository, for workers to pick up.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        queue (work_queue.WorkQueue): The work queue
+        args (argparse.Namespace): Parsed command line arguments
+    """
+    print "Syncing repository settings for {}".format(mh.org)
+    mh.sync_repo_metadata()
+    queue.create()
+    repos = [(r['id'], r['name'], [pr.number for pr in mh.get_migrated_prs(r['id'])])
+             for r in work_estimates(mh, args)]
+    added = queue.enqueue(repos, args.prs_per_item)
+    print "Queued {} work items for {} repositories".format(added, len(repos))
+
+
+def work(mh, queue, args):
+    """
+    Work through the queue until there's nothing left to claim. While
+    other workers still hold leases this keeps checking back, so an item
+    is picked up again if its worker dies.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        queue (work_queue.WorkQueue): The work queue
+        args (argparse.Namespace): Parsed command line arguments
+    Returns:
+        (bool): True if every item in the queue is done
+    """
+    from work_queue import LeaseLost
+
+    api = ApiCounter.for_session(mh.gh)
+    gh_repos = {}
+    completed = 0
+    while True:
+        remaining, reset = scheduler.rate_limit(mh.gh)
+        if remaining < MIN_CALLS:
+            print "Waiting until {} for the API rate limit to reset".format(time.strftime('%H:%M', time.localtime(reset)))
+            sleep(max(0, reset - time.time()) + 5)
+
+        item = queue.claim()
+        if item is None:
+            states = set(row['state'] for row in queue.status())
+            if 'leased' in states:
+                sleep(30)
+                continue
+            break
+
+        name = item['repository_name']
+        if name not in gh_repos:
+            gh_repos[name] = mh.gh.repository(mh.org, name)
+        beats = {'last': time.time()}
+
+        def heartbeat():
+            if time.time() - beats['last'] > queue.lease_seconds / 3:
+                queue.heartbeat(item)
+                beats['last'] = time.time()
+
+        try:
+            if item['phase'] == 'protection':
+                print "Migrating branch protection settings for {}".format(name)
+                migrate_branch_protection(mh, item['repository_id'], args.ghe_user, gh_repos[name])
+            else:
+                print "Migrating reviews for repo {} pull requests {}-{}".format(
+                    name, item['first_number'], item['last_number'])
+                migrate_reviews(mh, item['repository_id'], gh_repos[name], api,
+                                item['first_number'], item['last_number'], heartbeat)
+            queue.done(item)
+            completed += 1
+        except LeaseLost as e:
+            print e
+        except KeyboardInterrupt:
+            queue.release(item, "Interrupted")
+            raise
+        except Exception as e:
+            print "Work item {} failed: {}".format(item['id'], e)
+            queue.release(item, repr(e))
+
+    print "Completed {} work items".format(completed)
+    finished = all(row['state'] == 'done' for row in queue.status())
+    if finished:
+        # A repository with no pull requests after the review cutoff has
+        # no reviews items to do this at the end of, so once everything's
+        # done set the comments of every repository active. Any worker
+        # that gets here does it, which is harmless since it's idempotent.
+        print "Setting review comments active"
+        for repo_id in queue.repositories():
+            mh.set_comments_active(repo_id)
+    print mh.users.stats()
+    print peak_memory()
+    return finished
 
 
 def main():
@@ -173,10 +345,10 @@ def main():
     )
     parser.add_argument(
         '-g',
-        action='store',
+        action='append',
         required=True,
         dest='migration_guid',
-        help="The GUID of the migration you're working on as set by ghe-migrator."
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
     )
     parser.add_argument(
         '-o', '--organization',
@@ -191,6 +363,28 @@ def main():
         dest='ghe_user',
         help="Your GitHub Enterprise username."
     )
+    parser.add_argument(
+        '--order',
+        action='store',
+        choices=scheduler.STRATEGIES,
+        default='small-first',
+        dest='order',
+        help="The order to migrate repositories in. Defaults to small-first."
+    )
+    parser.add_argument(
+        '--critical',
+        action='store',
+        default='',
+        dest='critical',
+        help="Comma separated list of repositories to migrate first with --order critical-first."
+    )
+    parser.add_argument(
+        '--only',
+        action='store',
+        default='',
+        dest='only',
+        help="Comma separated list of repositories to work on, such as the ones verify reported."
+    )
 
     args = parser.parse_args()
     if args.github_username:
@@ -202,19 +396,8 @@ def main():
     if not migrator.org:
         parser.error("Unable to determine migrated organization name, please specify it with the -o option.")
 
-    migrated_repos = migrator.get_migrated_repositories()
-    for i in migrated_repos:
-        # Get the github.com version of the repo as an object
-        gh_repo = migrator.gh.repository(migrator.org, i['name'])
-
-        print "Setting feature options for repo {}".format(i['name'])
-        migrator.set_feature_options(i['id'], gh_repo.has_wiki, gh_repo.has_issues)
-
-        print "Migrating branch protection settings for {}".format(i['name'])
-        migrate_branch_protection(migrator, i['id'], args.ghe_user, gh_repo)
-
-        print "Migrating reviews for repo {}".format(i['name'])
-        migrate_reviews(migrator, i['id'], gh_repo)
+    run(migrator, args)
+    mark_finished(migrator.m, migrator.guids, 'complete')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+#!/usr/bin/env python2.7
+
+# database.py
+#
+# Shared bits for talking to the GitHub Enterprise MySQL database.
+
+import MySQLdb as mysql
+import time
+
+# InnoDB errors that mean the transaction lost out to another one and
+# is safe to retry from the start.
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_LOCK_DEADLOCK = 1213
+
+
+# Set by enable_profiling() to have connect() hand out profiled connections
+_profiler = None
+
+
+def _connect():
+    return mysql.connect(host='localhost', db='github_enterprise', charset='utf8')
+
+
+def connect():
+    """
+    Open a connection to the GitHub Enterprise database.
+
+    Returns:
+        (connection): MySQL connection
+    """
+    if _profiler is not None:
+        from sql_profiler import ProfiledConnection
+        return ProfiledConnection(_connect(), _profiler)
+    return _connect()
+
+
+def enable_profiling(profiler):
+    """
+    Time every statement run on connections opened from now on.
+
+    Arguments:
+        profiler (sql_profiler.Profiler): Where to record the timings
+    """
+    global _profiler
+    profiler.explain_connect = _connect
+    _profiler = profiler
+
+
+class UnitOfWork(object):
+    """
+    Groups writes into transactions that are committed once enough writes
+    have been made or enough time has gone by, instead of committing
+    after every write.
+
+    Each write is a function call that is remembered until the batch is
+    committed. If InnoDB picks the batch as a deadlock victim or it times
+    out waiting for a lock, the transaction is rolled back and every write
+    in the batch is run again, with an increasing wait between attempts.
+    For that to be safe the writes must only touch the database.
+
+    Commits only ever happen in checkpoint() and commit(), so a caller
+    that checkpoints at the end of each unit it can resume from (a pull
+    request, say) never has half a unit committed.
+    """
+    def __init__(self, m, max_writes=500, max_seconds=5.0, retries=5, backoff=0.5):
+        """
+        Arguments:
+            m (connection): Database connection
+            max_writes (int): Commit at the next checkpoint after this many
+                calls to run(), however many rows each of them writes
+            max_seconds (float): Commit at the next checkpoint after this long
+            retries (int): How many times to retry a batch
+            backoff (float): Seconds to wait before the first retry,
+                doubled for each one after
+        """
+        self.m = m
+        self.max_writes = max_writes
+        self.max_seconds = max_seconds
+        self.retries = retries
+        self.backoff = backoff
+        self.ops = []
+        self.started = time.time()
+        self.commits = 0
+        self.retried = 0
+
+    def run(self, func, *args, **kwargs):
+        """
+        Do a write as part of the current batch.
+
+        Arguments:
+            func (function): Function that does the write
+        Returns:
+            Whatever the function returns
+        """
+        self.ops.append((func, args, kwargs))
+        try:
+            return func(*args, **kwargs)
+        except mysql.OperationalError as e:
+            if e.args[0] not in (ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT):
+                raise
+            # This write is the last in the batch, so what the replay ends
+            # with is its result
+            return self._retry(e)
+
+    def checkpoint(self):
+        """
+        Mark a point it's safe to commit at, and commit if the batch is
+        big or old enough.
+        """
+        if len(self.ops) >= self.max_writes or time.time() - self.started >= self.max_seconds:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit the current batch.
+        """
+        try:
+            self.m.commit()
+        except mysql.OperationalError as e:
+            if e.args[0] not in (ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT):
+                raise
+            self._retry(e)
+            self.m.commit()
+        self.ops = []
+        self.started = time.time()
+        self.commits += 1
+
+    def rollback(self):
+        """
+        Throw away the current batch.
+        """
+        self.m.rollback()
+        self.ops = []
+        self.started = time.time()
+
+    def _retry(self, error):
+        """
+        Roll back and run every write in the batch again.
+
+        Arguments:
+            error (Exception): The deadlock or lock wait timeout
+        Returns:
+            Whatever the last write returned
+        """
+        for attempt in xrange(self.retries):
+            self.m.rollback()
+            self.retried += 1
+            time.sleep(self.backoff * (2 ** attempt))
+            try:
+                result = None
+                for func, args, kwargs in self.ops:
+                    result = func(*args, **kwargs)
+                return result
+            except mysql.OperationalError as e:
+                if e.args[0] not in (ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT):
+                    raise
+                error = e
+        self.m.rollback()
+        raise error
+
+
+class BulkWriter(object):
+    """
+    Buffers rows for a set of parameterized statements and writes them
+    with executemany, so a multi-row INSERT goes out as one statement and
+    a run of UPDATEs shares a single commit.
+
+    The writer gets its own connection so it can be used while another
+    connection is still streaming results.
+    """
+    def __init__(self, m, batch_size=1000):
+        self.m = m
+        self.c = m.cursor()
+        self.uow = UnitOfWork(m)
+        self.batch_size = batch_size
+        self.rows = {}
+        # Keep statements in the order they were first used so that, for
+        # example, fixes to existing rows go in before new rows that
+        # depend on them.
+        self.order = []
+        self.written = 0
+
+    def add(self, sql, row):
+        """
+        Queue a row for a statement, writing the batch out if it's full.
+
+        Arguments:
+            sql (str): The statement, with %s placeholders
+            row (tuple): The values for the placeholders
+        """
+        if sql not in self.rows:
+            self.rows[sql] = []
+            self.order.append(sql)
+        self.rows[sql].append(row)
+        if len(self.rows[sql]) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write out and commit everything that's queued, retrying the whole
+        lot if it deadlocks.
+        """
+        for sql in self.order:
+            if self.rows[sql]:
+                self.uow.run(self.c.executemany, sql, self.rows[sql])
+                self.written += len(self.rows[sql])
+                self.rows[sql] = []
+        self.uow.commit()
+
+
+# Bookkeeping for which phases have been run to completion for which
+# migrations, so that "all" can pick out the ones that still need work.
+RUNS_TABLE = 'ghe_migration_runs'
+# A migration is finished once these phases have completed for it.
+FINISHING_PHASES = ('events', 'complete')
+
+
+def sql_list(values):
+    """
+    Format values as the contents of a SQL IN (...) list.
+
+    Arguments:
+        values (list): The values
+    Returns:
+        (str): Quoted, comma separated values
+    """
+    return ', '.join("'{}'".format(mysql.escape_string(str(v))) for v in values)
+
+
+def resolve_guids(m, guids):
+    """
+    Expand the migration GUIDs given on the command line, each of which
+    can be several GUIDs separated by commas. The special value "all"
+    means every migration in migratable_resources that hasn't been
+    through all of FINISHING_PHASES yet.
+
+    Arguments:
+        m (connection): Database connection
+        guids (list): GUIDs from the command line
+    Returns:
+        (list): The GUIDs to work on, without duplicates
+    """
+    if isinstance(guids, basestring):
+        guids = [guids]
+    guids = [g.strip() for value in guids for g in value.split(',') if g.strip()]
+    if list(guids) != ['all']:
+        seen = set()
+        return [g for g in guids if not (g in seen or seen.add(g))]
+
+    c = m.cursor()
+    c.execute("SELECT DISTINCT guid FROM migratable_resources ORDER BY guid")
+    all_guids = [row[0] for row in c.fetchall()]
+    finished = set()
+    c.execute("SHOW TABLES LIKE '{}'".format(RUNS_TABLE))
+    if c.fetchone():
+        c.execute("""SELECT guid FROM {} WHERE phase IN ({})
+GROUP BY guid HAVING COUNT(DISTINCT phase)={}""".format(RUNS_TABLE, sql_list(FINISHING_PHASES), len(FINISHING_PHASES)))
+        finished = set(row[0] for row in c.fetchall())
+    c.close()
+    return [g for g in all_guids if g not in finished]
+
+
+def mark_finished(m, guids, phase):
+    """
+    Record that a phase has been run to completion for some migrations.
+
+    Arguments:
+        m (connection): Database connection
+        guids (list): The migration GUIDs
+        phase (str): The name of the phase
+    """
+    c = m.cursor()
+    c.execute("""CREATE TABLE IF NOT EXISTS {} (
+guid varchar(36) NOT NULL,
+phase varchar(32) NOT NULL,
+finished_at datetime NOT NULL,
+PRIMARY KEY (guid, phase)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8""".format(RUNS_TABLE))
+    c.executemany("""INSERT INTO {} (guid, phase, finished_at) VALUES (%s, %s, NOW())
+ON DUPLICATE KEY UPDATE finished_at=NOW()""".format(RUNS_TABLE), [(g, phase) for g in guids])
+    m.commit()
+    c.close()
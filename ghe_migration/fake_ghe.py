@@ -0,0 +1,168 @@
+#!/usr/bin/env python2.7
+
+# fake_ghe.py
+#
+# A fake of the GitHub Enterprise site admin API that ghe_admin.py uses,
+# to try out creating forks with impersonation tokens without an
+# appliance. It keeps everything in memory:
+#
+#   POST   /admin/users/:user/authorizations  - 201 with a new token, or
+#          200 with an empty token if the user already has one, the way
+#          GitHub Enterprise answers for an existing authorization
+#   POST   /repos/:org/:repo/forks            - 202, as whoever the token
+#          belongs to. Repositories called "broken" fail with a 500
+#   DELETE /admin/users/:user/authorizations  - 204, revoking the token
+#
+#   python fake_ghe.py             - run SiteAdmin against it and check
+#                                    what it did
+#   python fake_ghe.py serve 8000  - serve it on port 8000, for
+#                                    forks --admin-token admin --api-url http://localhost:8000
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from ghe_admin import SiteAdmin
+from SocketServer import ThreadingMixIn
+import json
+import sys
+import threading
+
+ADMIN_TOKEN = 'admin'
+
+
+class FakeGHE(ThreadingMixIn, HTTPServer):
+    """
+    The fake API. Everything it was asked to do is kept on it.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, existing=()):
+        """
+        Arguments:
+            port (int): Port to listen on, or 0 for any free one
+            existing (iterable): Logins that already have an impersonation
+                token, left over from an earlier run
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeGHEHandler)
+        self.lock = threading.Lock()
+        self.tokens = dict((login, 'left-over-{}'.format(login)) for login in existing)
+        self.calls = []
+        self.forks = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def login_for(self, token):
+        for login, t in self.tokens.items():
+            if t == token:
+                return login
+        return None
+
+
+class FakeGHEHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, body=None):
+        data = json.dumps(body) if body is not None else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        fake = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        token = (self.headers.get('Authorization') or '').replace('token ', '', 1)
+        parts = self.path.strip('/').split('/')
+        with fake.lock:
+            fake.calls.append((method, self.path))
+            if len(parts) == 4 and parts[0] == 'admin' and parts[3] == 'authorizations':
+                login = parts[2]
+                if token != ADMIN_TOKEN:
+                    return self._reply(401, {'message': 'Bad credentials'})
+                if method == 'DELETE':
+                    fake.tokens.pop(login, None)
+                    return self._reply(204)
+                if login in fake.tokens:
+                    return self._reply(200, {'token': ''})
+                fake.tokens[login] = 'token-{}-{}'.format(login, len(fake.calls))
+                return self._reply(201, {'token': fake.tokens[login]})
+            if len(parts) == 4 and parts[0] == 'repos' and parts[3] == 'forks' and method == 'POST':
+                login = fake.login_for(token)
+                if login is None:
+                    return self._reply(401, {'message': 'Bad credentials'})
+                if parts[2] == 'broken':
+                    return self._reply(500, {'message': 'Server Error'})
+                fake.forks.append((login, parts[1], parts[2]))
+                return self._reply(202, {'full_name': '{}/{}'.format(login, parts[2])})
+            return self._reply(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        if getattr(self.server, 'verbose', False):
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def check():
+    """
+    Create forks through the fake with SiteAdmin and check that every
+    fork was made as its user, that a left over token was replaced, that
+    a failed fork was reported and that no token was left behind.
+
+    Returns:
+        (list): What went wrong, empty if nothing did
+    """
+    fake = FakeGHE(existing=['carol'])
+    thread = threading.Thread(target=fake.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        admin = SiteAdmin.for_ghe('https://ghe.example.com', ADMIN_TOKEN, fake.url)
+        plan = [('alice', 'api'), ('alice', 'web'), ('bob', 'api'), ('bob', 'broken'), ('carol', 'web')]
+        results = dict((login, (forked, errors)) for login, forked, errors in admin.create_forks('org', plan, 2))
+    finally:
+        fake.shutdown()
+        fake.server_close()
+
+    problems = []
+    expected = [('alice', 'org', 'api'), ('alice', 'org', 'web'), ('bob', 'org', 'api'), ('carol', 'org', 'web')]
+    if sorted(fake.forks) != expected:
+        problems.append("Forks made: {}".format(sorted(fake.forks)))
+    if [name for name, _ in results.get('bob', ([], []))[1]] != ['broken']:
+        problems.append("bob's errors: {}".format(results.get('bob')))
+    for login in ('alice', 'carol'):
+        if results.get(login, ([], ['missing']))[1]:
+            problems.append("{}'s errors: {}".format(login, results.get(login)))
+    # carol's left over token comes back empty, so it's revoked and made again
+    carol = [call for call in fake.calls if '/users/carol/' in call[1]]
+    if [method for method, _ in carol] != ['POST', 'DELETE', 'POST', 'DELETE']:
+        problems.append("carol's token calls: {}".format(carol))
+    if fake.tokens:
+        problems.append("Tokens left behind: {}".format(fake.tokens))
+    return problems
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        fake = FakeGHE(int(sys.argv[2]) if len(sys.argv) > 2 else 8000)
+        fake.verbose = True
+        print "Serving a fake GitHub Enterprise API on {} with site admin token '{}'".format(fake.url, ADMIN_TOKEN)
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+    problems = check()
+    for problem in problems:
+        print problem
+    print "{} problems".format(len(problems)) if problems else "OK"
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
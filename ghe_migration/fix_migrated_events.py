@@ -21,205 +21,248 @@
 
 import MySQLdb as mysql
 import argparse
+from database import BulkWriter, UnitOfWork, connect, mark_finished, resolve_guids
 import itertools
+from progress import Progress, peak_memory
+from queries import Queries
+from records import Event, IssueTimes, PullRequestTimes
 import sys
 
 
-m = mysql.connect(host='localhost', db='github_enterprise')
-sc = m.cursor(mysql.cursors.DictCursor)
-ic = m.cursor()
+m = None
+q = None
+ss = None
+writer = None
 
-
-class Spinner():
-    spinner = itertools.cycle(['-', '\\', '|', '/'])
-    def spin(self):
-        sys.stdout.write(self.spinner.next())
-        sys.stdout.flush()
-        sys.stdout.write('\b')
-
-
-def fix_assignments(guid, repo):
-    sc.execute("""SELECT i.id AS issue_id, e.id AS event_id, d.id AS detail_id, i.repository_id AS repo,
-i.pull_request_id AS pr, e.actor_id AS actor, d.subject_id AS subject, i.created_at AS created
+# Every statement the fixes run, see queries.py
+STATEMENTS = {
+    'events': """SELECT i.id AS issue_id, i.pull_request_id AS pr, i.user_id AS issue_user,
+e.id AS event_id, e.event, e.actor_id AS actor, d.id AS detail_id, d.subject_id AS subject, e.created_at AS created
 FROM issue_events e
-LEFT OUTER JOIN issues AS i ON i.id=e.issue_id
+JOIN issues AS i ON i.id=e.issue_id
+JOIN (SELECT DISTINCT model_id FROM migratable_resources
+ WHERE guid IN (%s) AND model_name='issue_event') AS mr ON mr.model_id=e.id
 LEFT OUTER JOIN issue_event_details AS d ON d.issue_event_id=e.id
-WHERE e.id IN (SELECT model_id FROM migratable_resources WHERE guid='{}' AND model_name='issue_event')
-AND e.event='assigned' AND i.repository_id={}""".format(guid, repo))
-
-    assignments = sc.fetchall()
-    assignments_list = {}
-    spinner = Spinner()
-
-    for a in assignments:
-        spinner.spin()
-        assignments_list.setdefault(a['issue_id'], {})
-        if a['subject'] is None:
-            sc.execute("SELECT user_id FROM issues WHERE id={}".format(a['issue_id']))
-            issue_user = sc.fetchone()
-            a['subject'] = a['actor']
-            a['actor'] = issue_user['user_id']
-        if a['actor'] != a['subject']:
-            ic.execute("UPDATE issue_event_details SET subject_id={} WHERE id={}".format(a['actor'], a['detail_id']))
-            ic.execute("UPDATE issue_events SET actor_id={} WHERE id={}".format(a['subject'], a['event_id']))
-            m.commit()
-        assignments_list[a['issue_id']].setdefault(a['subject'], a['created'])
-
-    sc.execute("""SELECT i.id AS issue_id, e.id AS event_id, d.id AS detail_id, i.repository_id AS repo,
-i.pull_request_id AS pr, e.actor_id AS actor, d.subject_id AS subject, i.created_at AS created
-FROM issue_events e
-LEFT OUTER JOIN issues AS i ON i.id=e.issue_id
-LEFT OUTER JOIN issue_event_details AS d ON d.issue_event_id=e.id
-WHERE e.id IN (SELECT model_id FROM migratable_resources WHERE guid='{}' AND model_name='issue_event')
-AND e.event='unassigned' AND i.repository_id={}""".format(guid, repo))
-
-    unassignments = sc.fetchall()
-    emptied = []
-    for u in unassignments:
-        spinner.spin()
-        if u['actor'] != u['subject']:
-            ic.execute("UPDATE issue_event_details SET subject_id={} WHERE id={}".format(u['actor'], u['detail_id']))
-            ic.execute("UPDATE issue_events SET actor_id={} WHERE id={}".format(u['subject'], u['event_id']))
-            m.commit()
-        if u['subject'] in assignments_list[u['issue_id']]:
-            assignments_list[u['issue_id']].pop(u['subject'], None)
-            if len(assignments_list[u['issue_id']]) == 0:
-                emptied.append(u['issue_id'])
-    for e in emptied:
-        spinner.spin()
-        assignments_list.pop(e, None)
-
-    for al in assignments_list:
-        spinner.spin()
-        for i in assignments_list[al]:
-            ic.execute("INSERT INTO assignments (assignee_id, assignee_type, issue_id, created_at, updated_at) VALUES({0}, 'User', {1}, '{2}', '{2}')".format(i, al, assignments_list[al][i]))
-            m.commit()
-
-    print "- Done"
-
-
-def fix_review_requests(guid, repo):
-    sc.execute("""SELECT i.id AS issue_id, e.id AS event_id, d.id AS detail_id, i.repository_id AS repo,
-i.pull_request_id AS pr, e.actor_id AS actor, d.subject_id AS subject, i.created_at AS created
-FROM issue_events e
-LEFT OUTER JOIN issues AS i ON i.id=e.issue_id
-LEFT OUTER JOIN issue_event_details AS d ON d.issue_event_id=e.id
-WHERE e.id IN (SELECT model_id FROM migratable_resources WHERE guid='{}' AND model_name='issue_event')
-AND e.event='review_requested' AND i.repository_id={}""".format(guid, repo))
-
-    review_requests = sc.fetchall()
-    reviewer_list = {}
-    spinner = Spinner()
-
-    for r in review_requests:
-        spinner.spin()
-        reviewer_list.setdefault(r['pr'], {})
-        if r['actor'] != r['subject']:
-            ic.execute("UPDATE issue_event_details SET subject_id={} WHERE id={}".format(r['actor'], r['detail_id']))
-            ic.execute("UPDATE issue_events SET actor_id={} WHERE id={}".format(r['subject'], r['event_id']))
-            m.commit()
-        reviewer_list[r['pr']].setdefault(r['actor'], r['created'])
-
-    sc.execute("""SELECT i.id AS issue_id, e.id AS event_id, d.id AS detail_id, i.repository_id AS repo,
-i.pull_request_id AS pr, e.actor_id AS actor, d.subject_id AS subject, i.created_at AS created
-FROM issue_events e
-LEFT OUTER JOIN issues AS i ON i.id=e.issue_id
-LEFT OUTER JOIN issue_event_details AS d ON d.issue_event_id=e.id
-WHERE e.id IN (SELECT model_id FROM migratable_resources WHERE guid='{}' AND model_name='issue_event')
-AND e.event='review_request_removed' AND i.repository_id={}""".format(guid, repo))
-
-    rr_removals = sc.fetchall()
-    emptied = []
-    for rr in rr_removals:
-        spinner.spin()
-        if rr['actor'] != rr['subject']:
-            ic.execute("UPDATE issue_event_details SET subject_id={} WHERE id={}".format(rr['actor'], rr['detail_id']))
-            ic.execute("UPDATE issue_events SET actor_id={} WHERE id={}".format(rr['subject'], rr['event_id']))
-            m.commit()
-        if rr['actor'] in reviewer_list[rr['pr']]:
-            reviewer_list[rr['pr']].pop(rr['actor'], None)
-            if len(reviewer_list[rr['pr']]) == 0:
-                emptied.append(rr['pr'])
-    for e in emptied:
-        spinner.spin()
-        reviewer_list.pop(e, None)
-
-    for rl in reviewer_list:
-        spinner.spin()
-        for i in reviewer_list[rl]:
-            ic.execute("INSERT INTO review_requests (reviewer_id, pull_request_id, created_at, updated_at) VALUES ({0}, {1}, '{2}', '{2}')".format(
-                i,
-                rl,
-                reviewer_list[rl][i]
-            ))
-            m.commit()
-
-    print "- Done"
+WHERE e.event IN (%s) AND i.repository_id=%s
+ORDER BY e.issue_id, e.created_at, e.id""",
+    'update_subject': "UPDATE issue_event_details SET subject_id=%s WHERE id=%s",
+    'update_actor': "UPDATE issue_events SET actor_id=%s WHERE id=%s",
+    'insert_assignment': """INSERT INTO assignments (assignee_id, assignee_type, issue_id, created_at, updated_at)
+VALUES (%s, 'User', %s, %s, %s)""",
+    'insert_review_request': """INSERT INTO review_requests (reviewer_id, pull_request_id, created_at, updated_at)
+VALUES (%s, %s, %s, %s)""",
+    'issue_times': "SELECT id, updated_at, closed_at FROM issues WHERE repository_id=%s",
+    'set_issue_contributed': "UPDATE issues SET contributed_at_timestamp=%s, contributed_at_offset=-28800 WHERE id=%s",
+    'pr_times': "SELECT id, created_at, merged_at FROM pull_requests WHERE repository_id=%s",
+    'set_pr_contributed': "UPDATE pull_requests SET updated_at=%s, contributed_at_timestamp=%s, contributed_at_offset=-28800 WHERE id=%s",
+    'cross_references': "SELECT id FROM cross_references WHERE updated_at LIKE %s",
+    'set_cross_reference_updated': "UPDATE cross_references SET updated_at=referenced_at WHERE id=%s",
+    'migrated_repos': """SELECT DISTINCT model_id FROM migratable_resources
+WHERE guid IN (%s) AND model_name='repository'""",
+    'repo_name': "SELECT name FROM repositories WHERE id=%s",
+}
+
+
+def setup(connection, write_connection):
+    """
+    Set up the cursors used for the fixes.
+
+    Arguments:
+        connection (connection): Database connection for reads and the
+            per-row fixes
+        write_connection (connection): A second connection for bulk
+            writes. Event replay streams rows from the server rather
+            than loading a whole repository's worth at once and MySQL
+            doesn't allow other queries on a connection while it's
+            streaming.
+    """
+    global m, q, ss, writer
+    m = connection
+    q = Queries(m, STATEMENTS)
+    ss = m.cursor(mysql.cursors.SSCursor)
+    writer = BulkWriter(write_connection)
+
+
+def stream_events(guids, repo, events):
+    """
+    Stream the migrated issue events of the given types for a repository,
+    in the order they happened on each issue. An event that's part of
+    more than one of the migrations is only returned once.
+
+    Arguments:
+        guids (list): The migration GUIDs
+        repo (int): The local repository id
+        events (tuple): The event types to include
+    Returns:
+        (generator): A records.Event for each event
+    """
+    sql, params = q.sql('events', (guids, events, repo))
+    ss.execute(sql, params)
+    for row in iter(ss.fetchone, None):
+        yield Event(*row)
+
+
+def fix_reversed(event):
+    """
+    ghe-migrator swaps the actor and subject of assignment and review
+    request events. Queue the fix for an event if it needs one.
+
+    Arguments:
+        event (dict): The event row
+    """
+    if event.subject is not None and event.actor != event.subject:
+        if event.detail_id is not None:
+            writer.add(STATEMENTS['update_subject'], (event.actor, event.detail_id))
+        writer.add(STATEMENTS['update_actor'], (event.subject, event.event_id))
+
+
+def replay(events, group, member, added, removed):
+    """
+    Replay a stream of events to work out who ends up on each issue or
+    pull request. Only the state for the current group is kept, so the
+    events must be sorted by group and then in the order they happened.
+
+    Arguments:
+        events (iterable): Event rows
+        group (str): The key the events are grouped on
+        member (function): Gets the user an event is about
+        added (str): The event type that adds a user
+        removed (str): The event type that removes a user
+    Returns:
+        (generator): The group id and a dict of user id to the time they
+            were added, for each group that ends up with anyone in it
+    """
+    for key, group_events in itertools.groupby(events, lambda e: getattr(e, group)):
+        current = {}
+        for e in group_events:
+            user = member(e)
+            if e.event == added:
+                current.setdefault(user, e.created)
+            elif e.event == removed:
+                current.pop(user, None)
+        if current:
+            yield key, current
+
+
+def fix_assignments(guids, repo):
+    progress = Progress('events')
+
+    def assignee(a):
+        progress.update()
+        # Assignments with no details record had the assignee put in as
+        # the actor, and the issue author is who actually assigned them.
+        if a.subject is None and a.event == 'assigned':
+            a.subject = a.actor
+            a.actor = a.issue_user
+        fix_reversed(a)
+        return a.subject
+
+    events = stream_events(guids, repo, ('assigned', 'unassigned'))
+    for issue_id, assignees in replay(events, 'issue_id', assignee, 'assigned', 'unassigned'):
+        for user, created in assignees.iteritems():
+            writer.add(STATEMENTS['insert_assignment'], (user, issue_id, created, created))
+    writer.flush()
+
+    progress.finish("Done")
+
+
+def fix_review_requests(guids, repo):
+    progress = Progress('events')
+
+    def reviewer(r):
+        progress.update()
+        fix_reversed(r)
+        return r.actor
+
+    events = stream_events(guids, repo, ('review_requested', 'review_request_removed'))
+    for pr, reviewers in replay(events, 'pr', reviewer, 'review_requested', 'review_request_removed'):
+        for user, created in reviewers.iteritems():
+            writer.add(STATEMENTS['insert_review_request'], (user, pr, created, created))
+    writer.flush()
+
+    progress.finish("Done")
 
 
 def fix_timestamps(repo):
-    sc.execute("SELECT id, updated_at, closed_at FROM issues WHERE repository_id={}".format(repo))
-    issues = sc.fetchall()
-    spinner = Spinner()
+    # The updates are independent of each other, so commit them in
+    # batches rather than one at a time
+    uow = UnitOfWork(m)
+    issues = q.records('issue_times', IssueTimes, repo)
+    progress = Progress('issues', total=len(issues))
 
     for i in issues:
-        spinner.spin()
-        if i['closed_at']:
-            timestamp = i['closed_at'].strftime('%s')
+        progress.update()
+        if i.closed_at:
+            timestamp = i.closed_at.strftime('%s')
         else:
-            timestamp = i['updated_at'].strftime('%s')
-        ic.execute("UPDATE issues SET contributed_at_timestamp={}, contributed_at_offset=-28800 WHERE id={}".format(timestamp, i['id']))
-        m.commit()
-    sc.execute("SELECT id, created_at, merged_at FROM pull_requests where repository_id={}".format(repo))
-    prs = sc.fetchall()
+            timestamp = i.updated_at.strftime('%s')
+        uow.run(q.run, 'set_issue_contributed', timestamp, i.id)
+        uow.checkpoint()
+    uow.commit()
+    prs = q.records('pr_times', PullRequestTimes, repo)
+    progress.finish()
+    progress = Progress('pull requests', total=len(prs))
 
     for p in prs:
-        spinner.spin()
-        if p['merged_at']:
-            updated = p['merged_at']
+        progress.update()
+        if p.merged_at:
+            updated = p.merged_at
         else:
-            updated = p['created_at']
-        ic.execute("UPDATE pull_requests SET updated_at='{}', contributed_at_timestamp={}, contributed_at_offset=-28800 WHERE id={}".format(updated, updated.strftime('%s'), p['id']))
-        m.commit()
+            updated = p.created_at
+        uow.run(q.run, 'set_pr_contributed', updated, updated.strftime('%s'), p.id)
+        uow.checkpoint()
+    uow.commit()
 
-    sc.execute("SELECT id, referenced_at FROM cross_references WHERE updated_at like '2017-03-10%'")
-    crs = sc.fetchall()
+    crs = q.column('cross_references', '2017-03-10%')
+    progress.finish()
+    progress = Progress('cross references', total=len(crs))
 
     for c in crs:
-        spinner.spin()
-        ic.execute("UPDATE cross_references SET updated_at=referenced_at WHERE id={}".format(c['id']))
-        m.commit()
+        progress.update()
+        uow.run(q.run, 'set_cross_reference_updated', c)
+        uow.checkpoint()
+    uow.commit()
+
+    progress.finish("Done")
+
 
-    print "- Done"
+def run(guids):
+    """
+    Fix the events and timestamps for every repository in a set of
+    migrations.
+
+    Arguments:
+        guids (list): The migration GUIDs
+    """
+    print "Loading migrated repositories"
+    migrated_repos = q.rows('migrated_repos', guids)
+
+    for repo in migrated_repos:
+        repo_name = q.row('repo_name', repo['model_id'])
+        print "Fixing assignments for repo {}".format(repo_name['name'])
+        fix_assignments(guids, repo['model_id'])
+        print "Fixing review requests for repo {}".format(repo_name['name'])
+        fix_review_requests(guids, repo['model_id'])
+        print "Fixing timestamps for repo {}".format(repo_name['name'])
+        fix_timestamps(repo['model_id'])
+    print peak_memory()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-g',
-        action='store',
+        action='append',
         required=True,
         dest='migration_guid',
-        help="The GUID of the migration you're working on as set by ghe-migrator."
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
     )
 
     args = parser.parse_args()
-
-    sc.execute("""SELECT model_id FROM migratable_resources
-WHERE guid='{}' AND model_name='repository'""".format(args.migration_guid))
-
-    print "Loading migrated repositories"
-    migrated_repos = sc.fetchall()
-
-    for repo in migrated_repos:
-        sc.execute("SELECT name FROM repositories WHERE id={}".format(repo['model_id']))
-        repo_name = sc.fetchone()
-        sys.stdout.write("Fixing assignments for repo {} ".format(repo_name['name']))
-        fix_assignments(args.migration_guid, repo['model_id'])
-        sys.stdout.write("Fixing review requests for repo {} ".format(repo_name['name']))
-        fix_review_requests(args.migration_guid, repo['model_id'])
-        sys.stdout.write("Fixing timestamps for repo {} ".format(repo_name['name']))
-        fix_timestamps(repo['model_id'])
+    setup(connect(), connect())
+    guids = resolve_guids(m, args.migration_guid)
+    run(guids)
+    mark_finished(m, guids, 'events')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2.7
+
+# ghe_admin.py
+#
+# Creates forks on GitHub Enterprise as the users they belong to, using
+# the site admin API instead of swapping each user's password and
+# two-factor settings in the database. With a site admin token (one
+# with the site_admin scope) an impersonation token can be made for any
+# user:
+#
+#   POST   /admin/users/:user/authorizations  - get a token for the user
+#   POST   /repos/:org/:repo/forks            - fork, as that user
+#   DELETE /admin/users/:user/authorizations  - revoke it again
+#
+# so each user costs two calls on top of their forks, nothing in the
+# database is touched, and no account is ever left in an altered state.
+# Users are independent of each other so several are worked on at once.
+#
+# Everything goes through the API URL given to SiteAdmin, so it can be
+# pointed at the fake API in fake_ghe.py (forks --api-url) to try it out.
+
+from multiprocessing.pool import ThreadPool
+import requests
+
+
+class SiteAdmin(object):
+    """
+    The parts of the GitHub Enterprise API needed to fork as other users.
+    """
+    def __init__(self, api_url, token, verify=True, scopes=('repo',)):
+        """
+        Arguments:
+            api_url (str): Base URL of the API, like https://ghe.example.com/api/v3
+            token (str): Site admin token with the site_admin scope
+            verify (bool or str): Whether to verify the TLS certificate, or
+                the certificate to verify it with
+            scopes (tuple): Scopes for the impersonation tokens
+        """
+        self.api_url = api_url.rstrip('/')
+        self.token = token
+        self.verify = verify
+        self.scopes = list(scopes)
+
+    @classmethod
+    def for_ghe(cls, ghe_url, token, api_url=None):
+        """
+        Arguments:
+            ghe_url (str): URL for the GitHub Enterprise instance
+            token (str): Site admin token
+            api_url (str): Use this API instead of the instance's own,
+                like the one fake_ghe.py serves
+        Returns:
+            (SiteAdmin): Client for the API
+        """
+        if api_url:
+            return cls(api_url, token)
+        # This totally assumes a self-signed certificate, the same as
+        # MigrationHelper.create_local_fork
+        verify = '/etc/haproxy/ssl.crt' if ghe_url.startswith('https') else True
+        return cls(ghe_url.rstrip('/') + '/api/v3', token, verify)
+
+    def session(self):
+        """
+        Returns:
+            (requests.Session): A new session. Each thread uses its own.
+        """
+        s = requests.Session()
+        s.verify = self.verify
+        s.headers['Accept'] = 'application/vnd.github.v3+json'
+        return s
+
+    def _request(self, session, method, path, token, **kwargs):
+        response = session.request(method, self.api_url + path,
+                                   headers={'Authorization': 'token {}'.format(token)}, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def impersonate(self, session, login):
+        """
+        Get an impersonation token for a user.
+
+        Arguments:
+            session (requests.Session): Session to use
+            login (str): Local login
+        Returns:
+            (str): The token
+        """
+        path = '/admin/users/{}/authorizations'.format(login)
+        token = self._request(session, 'POST', path, self.token, json={'scopes': self.scopes}).json().get('token')
+        if not token:
+            # An impersonation token left over from an earlier run is
+            # returned without its value, so replace it with a new one
+            self.revoke(session, login)
+            token = self._request(session, 'POST', path, self.token, json={'scopes': self.scopes}).json().get('token')
+        if not token:
+            raise ValueError("No impersonation token was returned for {}".format(login))
+        return token
+
+    def revoke(self, session, login):
+        """
+        Revoke a user's impersonation token.
+
+        Arguments:
+            session (requests.Session): Session to use
+            login (str): Local login
+        """
+        self._request(session, 'DELETE', '/admin/users/{}/authorizations'.format(login), self.token)
+
+    def create_fork(self, session, token, org, repo_name):
+        """
+        Fork a repository for whoever the token belongs to.
+
+        Arguments:
+            session (requests.Session): Session to use
+            token (str): The user's impersonation token
+            org (str): The organization the repository is in
+            repo_name (str): The repository to fork
+        """
+        self._request(session, 'POST', '/repos/{}/{}/forks'.format(org, repo_name), token)
+
+    def forks_for_user(self, login, org, repo_names):
+        """
+        Create all of one user's forks with a single impersonation token,
+        revoking it afterwards however things went.
+
+        Arguments:
+            login (str): Local login
+            org (str): The organization the repositories are in
+            repo_names (list): The repositories to fork
+        Returns:
+            (str): The login
+            (list): The repositories that were forked
+            (list): (repository, error) for each one that couldn't be,
+                with a repository of None if the user couldn't be
+                impersonated at all
+        """
+        forked = []
+        errors = []
+        session = self.session()
+        try:
+            token = self.impersonate(session, login)
+        except Exception as e:
+            session.close()
+            return login, forked, [(None, str(e))]
+        try:
+            for name in repo_names:
+                try:
+                    self.create_fork(session, token, org, name)
+                    forked.append(name)
+                except Exception as e:
+                    errors.append((name, str(e)))
+        finally:
+            try:
+                self.revoke(session, login)
+            except Exception as e:
+                errors.append((None, "Could not revoke the impersonation token: {}".format(e)))
+            session.close()
+        return login, forked, errors
+
+    def create_forks(self, org, plan, threads=4):
+        """
+        Create forks for several users at once.
+
+        Arguments:
+            org (str): The organization the repositories are in
+            plan (list): (local login, repository name) for each fork
+            threads (int): How many users to work on at once
+        Returns:
+            (iterator): The result of forks_for_user for each user, as
+                they finish
+        """
+        by_user = {}
+        for login, name in plan:
+            by_user.setdefault(login, []).append(name)
+        pool = ThreadPool(threads)
+        try:
+            for result in pool.imap_unordered(lambda u: self.forks_for_user(u, org, by_user[u]), sorted(by_user)):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,551 @@
+#!/usr/bin/env python2.7
+
+# ghe_migrate.py
+#
+# One entry point for all the migration tools. Each phase is available
+# as a subcommand, and `all` runs the phases one after another in the
+# same process so they share a single database connection, a single
+# github.com session and the same user lookup cache instead of each
+# script logging in and warming everything up again from nothing.
+#
+# The heavy modules (github3.py, MySQLdb, dateutil) are only imported
+# by the subcommands that need them, so quick commands like `status`
+# and `plan` start fast.
+#
+# Every command that takes -g accepts several migration GUIDs (for an
+# organization that was exported as several archives) or "all" for
+# every migration that hasn't been through events and complete yet, and
+# works on the repositories of all of them as one set.
+#
+# --profile-sql FILE (before the subcommand) times every SQL statement the
+# command runs and reports the slowest (see sql_profiler.py).
+#
+#   status   - Summary of where a migration stands
+#   plan     - The order complete would work in, with API estimates and ETA
+#   prepare  - Create the helper indexes (see prepare_database.py)
+#   cleanup  - Drop the helper indexes
+#   events   - Fix assignments, review requests and timestamps
+#              (see fix_migrated_events.py)
+#   complete - Migrate settings, branch protections and reviews
+#              (see complete_migrations.py)
+#   enqueue  - Sync repository settings and queue the rest of complete
+#              as work items (see work_queue.py)
+#   worker   - Work through the queue, alongside any number of others
+#   queue    - Show how far the queued work has got
+#   forks    - Recreate forks (see recreate_forks.py)
+#   fetch    - Fetch github.com data into a snapshot (see offline_snapshot.py)
+#   apply    - Apply a snapshot to the database
+#   verify   - Compare what was migrated with github.com or a snapshot
+#              (see verify.py)
+#   all      - prepare, events, complete and, given -E, forks
+
+import argparse
+import sys
+
+
+class Context(object):
+    """
+    State shared between the phases of a run. Everything is created the
+    first time it's asked for.
+    """
+    def __init__(self, args, parser):
+        self.args = args
+        self.parser = parser
+        self._guids = None
+        self._db = None
+        self._write_db = None
+        self._gh = None
+        self._helper = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            from database import connect
+            self._db = connect()
+        return self._db
+
+    @property
+    def write_db(self):
+        if self._write_db is None:
+            from database import connect
+            self._write_db = connect()
+        return self._write_db
+
+    @property
+    def guids(self):
+        # Expand "all" once so every phase works on the same set
+        if self._guids is None:
+            from database import resolve_guids
+            self._guids = resolve_guids(self.db, self.args.migration_guid)
+            if not self._guids:
+                self.parser.error("There are no unfinished migrations.")
+            self.args.migration_guid = self._guids
+        return self._guids
+
+    @property
+    def gh(self):
+        if self._gh is None:
+            if not getattr(self.args, 'github_token', None) and not getattr(self.args, 'github_username', None):
+                self.parser.error("This command needs github.com credentials, use -t or -u.")
+            from github_data import github_login
+            self._gh = github_login(self.args)
+        return self._gh
+
+    @property
+    def has_credentials(self):
+        return bool(getattr(self.args, 'github_token', None) or getattr(self.args, 'github_username', None))
+
+    @property
+    def helper(self):
+        if self._helper is None:
+            from migration_helper import MigrationHelper
+            gh = self.gh if self.has_credentials else None
+            self.guids
+            self._helper = MigrationHelper(self.args, m=self.db, gh=gh)
+            if not self._helper.org:
+                self.parser.error("Unable to determine migrated organization name, please specify it with the -o option.")
+        return self._helper
+
+
+def cmd_status(ctx):
+    status = ctx.helper.get_migration_status()
+    print "Migrations {} for organization {}".format(', '.join(ctx.guids), ctx.helper.org)
+    for label, key in (
+            ("Repositories", 'repositories'),
+            ("Pull requests since the review cutoff", 'pull_requests'),
+            ("Reviews migrated", 'reviews'),
+            ("Repositories with reviews migrated", 'reviewed_repositories'),
+            ("Protected branches", 'protected_branches'),
+            ("Pending review comments", 'pending_comments'),
+            ("Assignments", 'assignments'),
+            ("Review requests", 'review_requests'),
+    ):
+        print "  {:<40} {}".format(label, status[key])
+    print "  {:<40} {}".format("Helper indexes prepared", 'yes' if ctx.helper.use_suffix_table else 'no')
+
+
+def cmd_plan(ctx):
+    import complete_migrations
+    import scheduler
+    import time
+
+    sched = scheduler.Scheduler(
+        complete_migrations.work_estimates(ctx.helper, ctx.args),
+        ctx.args.order,
+        [name for name in ctx.args.critical.split(',') if name]
+    )
+    for repo in sched.pending:
+        print "  {:<50} {:>6} PRs {:>4} branches ~{:>6.0f} calls".format(
+            repo['name'], repo['prs'], repo['branches'], sched.estimate(repo))
+    if ctx.has_credentials:
+        remaining, reset = scheduler.rate_limit(ctx.gh)
+    else:
+        remaining, reset = scheduler.RATE_LIMIT, time.time() + 3600
+    print sched.report(remaining, reset)
+
+
+def cmd_prepare(ctx):
+    import prepare_database
+    prepare_database.prepare(ctx.db, ctx.guids)
+
+
+def cmd_cleanup(ctx):
+    import prepare_database
+    prepare_database.cleanup(ctx.db)
+
+
+def cmd_events(ctx):
+    import fix_migrated_events
+    from database import mark_finished
+    fix_migrated_events.setup(ctx.db, ctx.write_db)
+    fix_migrated_events.run(ctx.guids)
+    mark_finished(ctx.db, ctx.guids, 'events')
+
+
+def cmd_complete(ctx):
+    import complete_migrations
+    from database import mark_finished
+    ctx.gh
+    complete_migrations.run(ctx.helper, ctx.args)
+    mark_finished(ctx.db, ctx.guids, 'complete')
+
+
+def cmd_enqueue(ctx):
+    import complete_migrations
+    from database import connect
+    from work_queue import WorkQueue
+    ctx.gh
+    complete_migrations.enqueue(ctx.helper, WorkQueue(connect()), ctx.args)
+
+
+def cmd_worker(ctx):
+    import complete_migrations
+    from database import connect, mark_finished
+    from work_queue import WorkQueue
+    ctx.gh
+    queue = WorkQueue(connect(), lease_seconds=ctx.args.lease)
+    if complete_migrations.work(ctx.helper, queue, ctx.args):
+        mark_finished(ctx.db, ctx.guids, 'complete')
+
+
+def cmd_queue(ctx):
+    from work_queue import WorkQueue
+    rows = WorkQueue(ctx.db).status()
+    if not rows:
+        print "Nothing has been queued"
+    for row in rows:
+        print "  {:<12} {:<10} {}".format(row['phase'], row['state'], row['items'])
+
+
+def cmd_forks(ctx):
+    import recreate_forks
+    from database import mark_finished
+    args = ctx.args
+    plan_only = getattr(args, 'plan_only', False)
+    inventory = getattr(args, 'fork_inventory', None) or recreate_forks.inventory_path(ctx.helper.org)
+    if getattr(args, 'refresh_forks', False) or not recreate_forks.inventory_complete(ctx.helper, inventory):
+        # Listing forks needs github.com, creating them from the cached
+        # inventory doesn't
+        ctx.helper.gh = ctx.gh
+    recreate_forks.run(ctx.helper, args.ghe_url, inventory, getattr(args, 'refresh_forks', False),
+                       getattr(args, 'fork_threads', 8), plan_only, getattr(args, 'admin_token', None),
+                       getattr(args, 'admin_api_url', None))
+    if not plan_only:
+        mark_finished(ctx.db, ctx.guids, 'forks')
+
+
+def cmd_fetch(ctx):
+    import offline_snapshot
+    offline_snapshot.fetch(ctx.gh, ctx.args)
+
+
+def cmd_apply(ctx):
+    import offline_snapshot
+    offline_snapshot.apply(ctx.helper, ctx.args)
+
+
+def cmd_verify(ctx):
+    import verify
+    if not ctx.args.snapshot:
+        # Comparing against github.com itself needs a login
+        ctx.gh
+    verify.run(ctx.helper, ctx.args)
+
+
+def cmd_all(ctx):
+    # Log in up front so a bad password doesn't turn up after the
+    # database phases have been running for an hour
+    ctx.gh
+    for name, phase in (
+            ('prepare', cmd_prepare),
+            ('events', cmd_events),
+            ('complete', cmd_complete),
+            ('forks', cmd_forks),
+    ):
+        if name == 'forks' and not ctx.args.ghe_url:
+            print "Skipping forks, no GitHub Enterprise URL given with -E"
+            continue
+        print "=== {} ===".format(name)
+        phase(ctx)
+    # The indexes and side table are left in place in case anything needs
+    # running again, but they don't belong on the appliance for good
+    print "Once you're happy with the migration, drop the helper indexes and side table with:"
+    print "  {} cleanup".format(sys.argv[0])
+
+
+def _auth_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    userauth = parser.add_mutually_exclusive_group()
+    userauth.add_argument(
+        '-t', '--token',
+        action='store',
+        dest='github_token',
+        help="GitHub OAuth token to use for authentication."
+    )
+    userauth.add_argument(
+        '-u', '--username',
+        action='store',
+        dest='github_username',
+        help="GitHub username."
+    )
+    userpass = parser.add_mutually_exclusive_group()
+    userpass.add_argument(
+        '-p', '--password',
+        action='store',
+        dest='github_password',
+        help="GitHub password."
+    )
+    userpass.add_argument(
+        '-P',
+        action='store_true',
+        dest='prompt_for_password',
+        help="Prompt for password instead of supplying it on the command line."
+    )
+    parser.add_argument(
+        '-2', '--two-factor',
+        action='store_true',
+        dest='github_two_factor',
+        help="Account requires 2-Factor authentication to access GitHub."
+    )
+    return parser
+
+
+def _migration_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-g',
+        action='append',
+        required=True,
+        dest='migration_guid',
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
+    )
+    parser.add_argument(
+        '-o', '--organization',
+        action='store',
+        dest='github_org',
+        help="The GitHub organization being migrated."
+    )
+    return parser
+
+
+def _local_user_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-l', '--local-user',
+        action='store',
+        required=True,
+        dest='ghe_user',
+        help="Your GitHub Enterprise username."
+    )
+    return parser
+
+
+def _ghe_url_parser(required):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-E', '--ghe-url',
+        action='store',
+        required=required,
+        dest='ghe_url',
+        help="URL for your GitHub Enterprise instance."
+    )
+    return parser
+
+
+def _schedule_parser():
+    import scheduler
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '--order',
+        action='store',
+        choices=scheduler.STRATEGIES,
+        default='small-first',
+        dest='order',
+        help="The order to migrate repositories in. Defaults to small-first."
+    )
+    parser.add_argument(
+        '--critical',
+        action='store',
+        default='',
+        dest='critical',
+        help="Comma separated list of repositories to migrate first with --order critical-first."
+    )
+    parser.add_argument(
+        '--only',
+        action='store',
+        default='',
+        dest='only',
+        help="Comma separated list of repositories to work on, such as the ones verify reported."
+    )
+    return parser
+
+
+def _snapshot_parser():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-f', '--file',
+        action='store',
+        required=True,
+        dest='snapshot',
+        help="Path to the snapshot archive."
+    )
+    parser.add_argument(
+        'repos',
+        nargs='*',
+        help="Only fetch or apply these repositories."
+    )
+    return parser
+
+
+def main():
+    auth = _auth_parser()
+    migration = _migration_parser()
+    local_user = _local_user_parser()
+    schedule = _schedule_parser()
+    snapshot = _snapshot_parser()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--profile-sql',
+        action='store',
+        metavar='FILE',
+        dest='profile_sql',
+        help="Time every SQL statement, print the slowest at the end and write the full report to FILE as JSON."
+    )
+    parser.add_argument(
+        '--profile-threshold',
+        action='store',
+        type=float,
+        default=0.5,
+        dest='profile_threshold',
+        help="Capture the EXPLAIN plan of statements slower than this many seconds. Defaults to 0.5."
+    )
+    parser.add_argument(
+        '--profile-top',
+        action='store',
+        type=int,
+        default=20,
+        dest='profile_top',
+        help="How many statements to show in the profile report. Defaults to 20."
+    )
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('status', parents=[migration],
+                          help="Show where a migration stands.")
+    subparsers.add_parser('plan', parents=[auth, migration, schedule],
+                          help="Show the order repositories would be completed in, with estimates.")
+    subparsers.add_parser('prepare', parents=[migration],
+                          help="Create the helper indexes and side table.")
+    subparsers.add_parser('cleanup',
+                          help="Drop the helper indexes and side table.")
+    subparsers.add_parser('events', parents=[migration],
+                          help="Fix assignments, review requests and timestamps.")
+    subparsers.add_parser('complete', parents=[auth, migration, local_user, schedule],
+                          help="Migrate repository settings, branch protections and reviews.")
+    enqueue_parser = subparsers.add_parser('enqueue', parents=[auth, migration, schedule],
+                                           help="Sync repository settings and queue the rest of complete for workers.")
+    enqueue_parser.add_argument(
+        '--prs-per-item',
+        action='store',
+        type=int,
+        default=100,
+        dest='prs_per_item',
+        help="How many pull requests each reviews work item covers. Defaults to 100."
+    )
+    worker_parser = subparsers.add_parser('worker', parents=[auth, migration, local_user],
+                                          help="Work through the queued items. Run as many as you like, on as many machines.")
+    worker_parser.add_argument(
+        '--lease',
+        action='store',
+        type=int,
+        default=600,
+        dest='lease',
+        help="Seconds before an item whose worker has stopped responding is given to another. Defaults to 600."
+    )
+    subparsers.add_parser('queue',
+                          help="Show how far the queued work has got.")
+    forks_parser = subparsers.add_parser('forks', parents=[auth, migration, _ghe_url_parser(True)],
+                                         help="Recreate forks.")
+    forks_parser.add_argument(
+        '--inventory',
+        action='store',
+        dest='fork_inventory',
+        help="Where to cache the list of forks. Defaults to forks-<organization>.json."
+    )
+    forks_parser.add_argument(
+        '--refresh',
+        action='store_true',
+        dest='refresh_forks',
+        help="List the forks of every repository again instead of using the cached list."
+    )
+    forks_parser.add_argument(
+        '--threads',
+        action='store',
+        type=int,
+        default=8,
+        dest='fork_threads',
+        help="How many repositories to list forks for, or users to create forks for, at once. Defaults to 8."
+    )
+    forks_parser.add_argument(
+        '--admin-token',
+        action='store',
+        dest='admin_token',
+        help="GitHub Enterprise site admin token. Forks are created with an impersonation token for each user instead of by swapping their password."
+    )
+    forks_parser.add_argument(
+        '--api-url',
+        action='store',
+        dest='admin_api_url',
+        help="With --admin-token, create the forks through this API instead of the instance's own, for example the one fake_ghe.py serves."
+    )
+    forks_parser.add_argument(
+        '--plan',
+        action='store_true',
+        dest='plan_only',
+        help="Only show which forks would be created."
+    )
+    fetch_parser = subparsers.add_parser('fetch', parents=[auth, snapshot],
+                                         help="Fetch github.com data into a snapshot archive.")
+    fetch_parser.add_argument(
+        '-o', '--organization',
+        action='store',
+        required=True,
+        dest='github_org',
+        help="The GitHub organization being migrated."
+    )
+    subparsers.add_parser('apply', parents=[migration, local_user, _ghe_url_parser(False), snapshot],
+                          help="Apply a snapshot archive to the local database.")
+    verify_parser = subparsers.add_parser('verify', parents=[auth, migration],
+                                          help="Compare what was migrated with github.com or a snapshot.")
+    verify_parser.add_argument(
+        '-f', '--file',
+        action='store',
+        dest='snapshot',
+        help="Compare with this snapshot archive instead of github.com."
+    )
+    verify_parser.add_argument(
+        '--reviews',
+        action='store_true',
+        dest='reviews',
+        help="Also compare reviews when checking against github.com. This takes one API call per pull request."
+    )
+    verify_parser.add_argument(
+        '--output',
+        action='store',
+        dest='output',
+        help="Write the mismatches to this file as JSON."
+    )
+    verify_parser.add_argument(
+        'repos',
+        nargs='*',
+        help="Only verify these repositories."
+    )
+    subparsers.add_parser('all', parents=[auth, migration, local_user, _ghe_url_parser(False), schedule],
+                          help="Run prepare, events, complete and forks in one go.")
+
+    args = parser.parse_args()
+    if getattr(args, 'github_username', None):
+        if not args.github_password and not args.prompt_for_password:
+            parser.error("When using a username to login, you must use either -p to supply a password or -P to prompt for your password.")
+
+    profiler = None
+    if args.profile_sql:
+        # Has to be turned on before the first connection is opened
+        import database
+        from sql_profiler import Profiler
+        profiler = Profiler(args.profile_sql, args.profile_threshold, args.profile_top)
+        database.enable_profiling(profiler)
+
+    ctx = Context(args, parser)
+    try:
+        globals()['cmd_' + args.command](ctx)
+    finally:
+        # Report even if the run fails or is interrupted, since that's
+        # often when the numbers are most interesting
+        if profiler:
+            print profiler.report()
+            profiler.write()
+            profiler.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+#!/usr/bin/env python2.7
+
+# github_data.py
+#
+# Helpers for pulling the pieces of github.com data that the migration
+# scripts need out of the github3.py objects and into plain dicts and
+# compact records (see records.py), so the github3.py objects and their
+# raw JSON can be thrown away as soon as possible. Keeping this separate from migration_helper.py means it can be
+# used on a machine that has no access to the GitHub Enterprise MySQL
+# database (and no MySQLdb module installed), which is what the offline
+# snapshot fetch relies on.
+#
+# Everything returned from here is JSON serializable, or has an as_dict
+# that is, so it can be written straight into a snapshot archive.
+
+import getpass
+from datetime import datetime as dt
+from records import Dismissal, Review, id_array
+
+# Reviews were added as a feature in mid-September of 2016, so any
+# pull requests that were merged before then can be safely ignored as
+# having no reviews. For extra care we're setting the cutoff at
+# 1 September 2016
+REVIEW_CUTOFF = dt(2016, 9, 1, 12, 0, 0)
+
+
+def _twofa():
+    """
+    Callback function to handle 2-factor authentication
+    for GitHub accounts that require it.
+
+    Returns: (str) Access token
+    """
+    code = ''
+    while not code:
+        code = raw_input('2FA Code: ')
+    return code
+
+
+def github_login(args):
+    """
+    Log in to github.com using the credentials supplied on the command line.
+
+    Arguments:
+        args (argparse.Namespace): Parsed command line arguments
+    Returns:
+        (github3.GitHub): Authenticated GitHub session
+    """
+    # github3.py takes a while to import, so only pay for it when we're
+    # actually going to talk to github.com
+    import github3
+
+    if getattr(args, 'github_token', None):
+        return github3.login(token=args.github_token)
+
+    twofactor = None
+    if args.prompt_for_password:
+        passwd = ''
+        while not passwd:
+            passwd = getpass.getpass('GitHub Password: ')
+    else:
+        passwd = args.github_password
+    if args.github_two_factor:
+        twofactor = _twofa
+
+    return github3.login(username=args.github_username, password=passwd, two_factor_callback=twofactor)
+
+
+def _isoformat(timestamp):
+    """
+    github3.py hands back some timestamps as datetime objects and some
+    as the raw strings from the API, so normalize them to strings.
+    """
+    if timestamp is None:
+        return None
+    if isinstance(timestamp, basestring):
+        return timestamp
+    return timestamp.replace(tzinfo=None).isoformat()
+
+
+def repo_metadata(gh_repo):
+    """
+    Get the repository level settings that ghe-migrator doesn't carry over.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+    Returns:
+        (dict): The name, feature flags and pushed_at time of the repository
+    """
+    return {
+        'name': gh_repo.name,
+        'has_wiki': bool(gh_repo.has_wiki),
+        'has_issues': bool(gh_repo.has_issues),
+        'pushed_at': _isoformat(gh_repo.pushed_at),
+    }
+
+
+def branch_protections(gh_repo):
+    """
+    Get the full protection settings for every protected branch.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+    Returns:
+        (generator): (branch name, protection dict) for each protected branch
+    """
+    for branch in gh_repo.branches():
+        if branch.protected:
+            yield branch.name, branch.protection_full()
+
+
+def protected_branch_names(gh_repo):
+    """
+    Get the names of the protected branches from the branch listing,
+    without fetching the protection settings of each.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+    Returns:
+        (list): The protected branch names
+    """
+    return [branch.name for branch in per_page(gh_repo.branches()) if branch.protected]
+
+
+def issue_assignees(gh_repo):
+    """
+    Count the assignees of every issue and pull request in a repository
+    from the issue listing.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+    Returns:
+        (generator): (number, assignee count) for each issue
+    """
+    for issue in per_page(gh_repo.issues(state='all')):
+        assignees = getattr(issue, 'assignees', None)
+        if assignees is None:
+            assignees = [issue.assignee] if issue.assignee else []
+        yield issue.number, len(assignees)
+
+
+def pr_reviews(gh_pr):
+    """
+    Get the reviews for a pull request along with the ids of the review
+    comments that belong to each of them.
+
+    Arguments:
+        gh_pr (github3.pulls.PullRequest): The github.com pull request object
+    Returns:
+        (list): A Review for each review, in the order github.com returns them
+    """
+    reviews = []
+    by_id = {}
+    for rev in gh_pr.reviews():
+        review = Review(
+            rev.id,
+            rev.user.login,
+            rev.state,
+            rev.commit_id,
+            rev.body,
+            _isoformat(rev.submitted_at),
+            id_array(),
+        )
+        reviews.append(review)
+        by_id[rev.id] = review
+    if not reviews:
+        return reviews
+
+    for com in gh_pr.review_comments():
+        if com.pull_request_review_id in by_id:
+            by_id[com.pull_request_review_id].comments.append(com.id)
+    return reviews
+
+
+def review_dismissals(gh_pr):
+    """
+    Get the review dismissal events from the timeline of a pull request.
+
+    Arguments:
+        gh_pr (github3.pulls.PullRequest): The github.com pull request object
+    Returns:
+        (list): A Dismissal for each dismissal event
+    """
+    dismissals = []
+    for e in gh_pr.issue().events():
+        dismissed = getattr(e, 'dismissed_review', False)
+        if dismissed:
+            dismissals.append(Dismissal(
+                e.id,
+                dismissed.get('review_id'),
+                dismissed['state'],
+                dismissed.get('dismissal_message') or '',
+            ))
+    return dismissals
+
+
+def per_page(iterator, n=100):
+    """
+    Have a github3.py listing fetch n items per request. github3.py only
+    sets a page size when a listing is limited to at most 100 items, so
+    listing everything gets the API's default of 30 per page and a long
+    listing takes three times the calls it needs to.
+
+    Arguments:
+        iterator (github3.structs.GitHubIterator): The listing
+        n (int): Items per page, at most 100
+    Returns:
+        (GitHubIterator): The same listing
+    """
+    iterator.params['per_page'] = n
+    return iterator
+
+
+def fork_owners(gh_repo):
+    """
+    Get the logins of the users that have forked a repository.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+    Returns:
+        (list): github.com logins of the fork owners
+    """
+    return [fork.owner.login for fork in per_page(gh_repo.forks())]
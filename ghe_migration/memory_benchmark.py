@@ -0,0 +1,69 @@
+#!/usr/bin/env python2.7
+
+# memory_benchmark.py
+#
+# Measures what holding the migration's data as __slots__ records (see
+# records.py) saves over holding it as dicts. A synthetic set of
+# reviews (each with a few review comment ids), events and pull request
+# rows, sized like a large repository, is built one way or the other
+# and the peak memory of the process is reported. Each way is run in a
+# process of its own, since peak memory only ever goes up.
+#
+#   python memory_benchmark.py              - both, 100000 of each
+#   python memory_benchmark.py both 1e6     - both, a million of each
+#   python memory_benchmark.py records 1e5  - just the records
+
+from datetime import datetime as dt
+from progress import peak_memory
+from records import Event, PullRequest, Review, id_array
+import subprocess
+import sys
+
+COMMENTS_PER_REVIEW = 4
+
+
+def build(mode, n):
+    """
+    Build n reviews, events and pull request rows.
+
+    Arguments:
+        mode (str): "dicts" or "records"
+        n (int): How many of each
+    Returns:
+        (tuple): The reviews, events and pull requests
+    """
+    now = dt(2017, 4, 14, 12, 0, 0)
+    reviews = []
+    events = []
+    prs = []
+    for i in xrange(n):
+        review = {'id': i, 'user': 'user{}'.format(i % 500), 'state': 'APPROVED',
+                  'commit_id': '{:040x}'.format(i), 'body': '', 'submitted_at': '2017-04-14T12:00:00Z',
+                  'comments': range(i, i + COMMENTS_PER_REVIEW)}
+        event = {'issue_id': i, 'pr': i, 'issue_user': i % 500, 'event_id': i, 'event': 'assigned',
+                 'actor': i % 500, 'detail_id': i, 'subject': i % 500, 'created': now}
+        pr = {'id': i, 'updated_at': now, 'number': i}
+        if mode == 'records':
+            review['comments'] = id_array(review['comments'])
+            review = Review(**review)
+            event = Event(**event)
+            pr = PullRequest(**pr)
+        reviews.append(review)
+        events.append(event)
+        prs.append(pr)
+    return reviews, events, prs
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'both'
+    n = int(float(sys.argv[2])) if len(sys.argv) > 2 else 100000
+    if mode == 'both':
+        for mode in ('dicts', 'records'):
+            subprocess.check_call([sys.executable, __file__, mode, str(n)])
+        return
+    data = build(mode, n)
+    print "{:<8} {} reviews, events and pull requests - {}".format(mode, len(data[0]), peak_memory())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,10 +14,114 @@
 # Mark Troyer <disco@blackops.io>
 
 import MySQLdb as mysql
-import codecs
+from contextlib import contextmanager
+from database import UnitOfWork, connect, resolve_guids
 from datetime import datetime as dt
-import getpass
-import github3
+from github_data import REVIEW_CUTOFF, github_login, per_page, repo_metadata
+from prepare_database import SUFFIX_TABLE, suffix_table_ready
+from queries import Queries
+from records import LocalReview, PullRequest, id_array
+from user_directory import UserDirectory
+
+# The local repositories of the migrations being worked on
+_MIGRATED_REPOS = """SELECT DISTINCT model_id FROM migratable_resources
+WHERE guid IN (%s) AND model_name='repository'"""
+
+# Every statement MigrationHelper runs. Values are always passed as
+# parameters, see queries.py.
+STATEMENTS = {
+    'org_id': "SELECT id FROM users WHERE login=%s",
+    'migrated_org': """SELECT id, login FROM users
+WHERE id=(SELECT DISTINCT model_id FROM migratable_resources WHERE guid IN (%s) AND model_name='organization')""",
+    'model_id_by_reversed_url': """SELECT model_id FROM {}
+WHERE guid IN (%s) AND reversed_url LIKE %s""".format(SUFFIX_TABLE),
+    'model_id_by_url': """SELECT model_id FROM migratable_resources
+WHERE guid IN (%s) AND source_url LIKE %s""",
+    'migrated_prs': """SELECT pr.id, pr.updated_at, i.number FROM pull_requests pr, issues i
+WHERE pr.repository_id=%s AND pr.updated_at>%s AND i.pull_request_id=pr.id
+ORDER BY i.number""",
+    'reviewed_prs': """SELECT DISTINCT i.number FROM pull_request_reviews prr
+JOIN pull_requests AS pr ON pr.id=prr.pull_request_id
+JOIN issues AS i ON i.pull_request_id=pr.id
+WHERE pr.repository_id=%s AND i.number BETWEEN %s AND %s""",
+    # A locking read, so it sees reviews committed by other workers since
+    # the current transaction started
+    'pr_has_reviews': """SELECT 1 FROM pull_request_reviews WHERE pull_request_id=%s LIMIT 1
+LOCK IN SHARE MODE""",
+    'migrated_repositories': """SELECT DISTINCT r.id, r.name FROM repositories r
+JOIN migratable_resources AS mr ON mr.model_id=r.id
+WHERE mr.guid IN (%s) AND mr.model_name='repository'""",
+    'repo_work_estimates': """SELECT r.id, r.name, COUNT(DISTINCT pr.id) AS prs, COUNT(DISTINCT pr.base_ref) AS branches
+FROM repositories r
+JOIN migratable_resources AS mr ON mr.model_id=r.id
+LEFT OUTER JOIN pull_requests AS pr ON pr.repository_id=r.id AND pr.updated_at>%s
+WHERE mr.guid IN (%s) AND mr.model_name='repository'
+GROUP BY r.id, r.name""",
+    'migration_status': """SELECT
+(SELECT COUNT(*) FROM ({0}) AS r) AS repositories,
+(SELECT COUNT(*) FROM pull_requests pr JOIN ({0}) AS r ON r.model_id=pr.repository_id
+ WHERE pr.updated_at>%s) AS pull_requests,
+(SELECT COUNT(*) FROM pull_request_reviews prr JOIN pull_requests AS pr ON pr.id=prr.pull_request_id
+ JOIN ({0}) AS r ON r.model_id=pr.repository_id) AS reviews,
+(SELECT COUNT(DISTINCT pr.repository_id) FROM pull_request_reviews prr JOIN pull_requests AS pr ON pr.id=prr.pull_request_id
+ JOIN ({0}) AS r ON r.model_id=pr.repository_id) AS reviewed_repositories,
+(SELECT COUNT(*) FROM protected_branches pb JOIN ({0}) AS r ON r.model_id=pb.repository_id) AS protected_branches,
+(SELECT COUNT(*) FROM pull_request_review_comments c JOIN ({0}) AS r ON r.model_id=c.repository_id
+ WHERE c.state=0) AS pending_comments,
+(SELECT COUNT(*) FROM assignments a JOIN issues AS i ON i.id=a.issue_id
+ JOIN ({0}) AS r ON r.model_id=i.repository_id) AS assignments,
+(SELECT COUNT(*) FROM review_requests rr JOIN pull_requests AS pr ON pr.id=rr.pull_request_id
+ JOIN ({0}) AS r ON r.model_id=pr.repository_id) AS review_requests""".format(_MIGRATED_REPOS),
+    'protected_branches': "SELECT name FROM protected_branches WHERE repository_id=%s",
+    'set_feature_options': "UPDATE repositories SET has_wiki=%s, has_issues=%s WHERE id=%s",
+    'drop_metadata_staging': "DROP TEMPORARY TABLE IF EXISTS repository_metadata_staging",
+    'create_metadata_staging': """CREATE TEMPORARY TABLE repository_metadata_staging (
+name varchar(100) NOT NULL PRIMARY KEY,
+has_wiki tinyint(1) NOT NULL,
+has_issues tinyint(1) NOT NULL,
+pushed_at datetime DEFAULT NULL
+) DEFAULT CHARSET=utf8""",
+    'stage_repo_metadata': """INSERT INTO repository_metadata_staging (name, has_wiki, has_issues, pushed_at)
+VALUES (%s, %s, %s, %s)""",
+    'sync_repo_metadata': """UPDATE repositories r
+JOIN repository_metadata_staging AS s ON s.name=r.name
+JOIN migratable_resources AS mr ON mr.model_id=r.id AND mr.guid IN (%s) AND mr.model_name='repository'
+SET r.has_wiki=s.has_wiki, r.has_issues=s.has_issues, r.pushed_at=COALESCE(s.pushed_at, r.pushed_at)""",
+    'insert_protected_branch': """INSERT INTO protected_branches
+(repository_id, name, created_at, updated_at, creator_id,
+required_status_checks_enforcement_level, strict_required_status_checks_policy,
+authorized_actors_only, pull_request_reviews_enforcement_level)
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+    'insert_status_check': """INSERT INTO required_status_checks
+(protected_branch_id, context, created_at, updated_at)
+VALUES(%s, %s, %s, %s)""",
+    'insert_ability': """INSERT INTO abilities
+(action, actor_id, actor_type, created_at, parent_id, priority, subject_id, subject_type, updated_at)
+VALUES(1, %s, %s, %s, 0, 1, %s, 'ProtectedBranch', %s)""",
+    'set_comments_active': """UPDATE pull_request_review_comments SET state=1
+WHERE repository_id=%s AND state=0""",
+    'set_repo_pushed': "UPDATE repositories SET pushed_at=%s WHERE id=%s",
+    'insert_review': """INSERT INTO pull_request_reviews
+(pull_request_id, user_id, state, head_sha, body, created_at, updated_at, submitted_at, formatter)
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+    'link_review_comment': """UPDATE pull_request_review_comments
+SET pull_request_review_id=%s WHERE id=%s""",
+    'review_request': """SELECT id, updated_at FROM review_requests
+WHERE pull_request_id=%s AND reviewer_id=%s""",
+    'delete_review_request': "DELETE FROM review_requests WHERE id=%s",
+    'dismiss_review': """UPDATE issue_event_details
+SET pull_request_review_state_was=%s, message=%s, pull_request_review_id=%s
+WHERE issue_event_id=%s""",
+    'user_crypt': "SELECT bcrypt_auth_token FROM users WHERE login=%s",
+    'set_user_crypt': "UPDATE users SET bcrypt_auth_token=%s WHERE login=%s",
+    'two_factor': """SELECT id, secret, recovery_secret as rs, recovery_used_bitfield as rub,
+user_id, created_at as ca, updated_at as ua, sms_number as sms, delivery_method as dm,
+backup_sms_number as bsms, recovery_codes_viewed as rcv, provider
+FROM two_factor_credentials WHERE user_id=%s""",
+    'delete_two_factor': "DELETE FROM two_factor_credentials WHERE id=%s",
+    'restore_two_factor': """INSERT INTO two_factor_credentials
+VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+}
 
 
 class MigrationHelper(object):
@@ -25,76 +129,108 @@ class MigrationHelper(object):
     m = None
     sc = None
     ic = None
-    guid = None
+    guids = None
     org = None
     org_id = None
+    q = None
+    users = None
+    uow = None
+    use_suffix_table = False
     review_states = {
         'COMMENTED': 1,
         'CHANGES_REQUESTED': 30,
         'APPROVED': 40,
         'DISMISSED': 50,
     }
-    _user_cache = {}
 
-    # Set up the GitHub API and MySQL connections
-    def __init__(self, args):
-        if 'github_token' in args:
-            self.gh = github3.login(token=args.github_token)
-        else:
-            twofactor = None
-            if args.prompt_for_password:
-                passwd = ''
-                while not passwd:
-                    passwd = getpass('GitHub Password: ')
-            else:
-                passwd = args.github_password
-            if args.github_two_factor:
-                twofactor = self._twofa
-
-            self.gh = github3.login(username=args.github_username, password=passwd, two_factor_callback=twofactor)
-        self.m = mysql.connect(host='localhost', db='github_enterprise', charset='utf8')
-        self.sc = self.m.cursor(mysql.cursors.DictCursor)
-        self.ic = self.m.cursor()
-        self.guid = args.migration_guid
+    # Set up the GitHub API and MySQL connections. The github.com login
+    # is skipped when no credentials are supplied so that work which only
+    # touches the local database (like applying an offline snapshot) can
+    # run on the appliance without network access. An existing GitHub
+    # session and database connection can be passed in so that several
+    # phases run in one process can share them.
+    def __init__(self, args, m=None, gh=None):
+        if gh:
+            self.gh = gh
+        elif getattr(args, 'github_token', None) or getattr(args, 'github_username', None):
+            self.gh = github_login(args)
+        self.m = m or connect()
+        self.q = Queries(self.m, STATEMENTS)
+        self.sc = self.q.dc
+        self.ic = self.q.c
+        # Several migrations (split archives of the same organization, for
+        # example) can be worked on together, in which case every query
+        # covers all of them.
+        self.guids = resolve_guids(self.m, args.migration_guid)
+        self.users = UserDirectory(self.m, self.guids)
+        self.use_suffix_table = bool(self.guids) and suffix_table_ready(self.ic, self.guids)
         if args.github_org:
             self.org = args.github_org
-            self.sc.execute("SELECT id FROM users WHERE login='{}'".format(self.org))
-            ans = self.sc.fetchone()
-            self.org_id = ans['id']
+            self.org_id = self.q.value('org_id', self.org)
         else:
             migrated_org = self._get_migrated_organization()
             if migrated_org:
                 self.org = migrated_org['login']
                 self.org_id = migrated_org['id']
 
-    def _twofa(self):
+    @contextmanager
+    def unit_of_work(self, **kwargs):
+        """
+        Batch up writes instead of committing after each one. While the
+        unit of work is active the write methods below leave committing to
+        it, so they need to be called through its run() method in order to
+        be retried if the batch deadlocks. Whatever is left is committed
+        when the block finishes, and rolled back if it raises.
+
+        Arguments:
+            kwargs: Batch size and retry options for database.UnitOfWork
+        Returns:
+            (UnitOfWork): The unit of work
         """
-        Callback function to handle 2-factor authentication
-        for GitHub accounts that require it.
+        self.uow = UnitOfWork(self.m, **kwargs)
+        try:
+            yield self.uow
+            self.uow.commit()
+        except Exception:
+            self.uow.rollback()
+            raise
+        finally:
+            self.uow = None
 
-        Returns: (str) Access token
+    def _commit(self):
         """
-        code = ''
-        while not code:
-            code = raw_input('2FA Code: ')
-        return code
+        Commit, unless there's a unit of work that will do it later.
+        """
+        if self.uow is None:
+            self.m.commit()
 
     def _get_user_id(self, username):
         """
-        Look up and cache the local user id number for a migrated
-        GitHub user account.
+        Look up the local user id number for a migrated GitHub user account.
 
         Arguments:
             username (str): The github.com user name
         Returns:
-             (int): The local user id number
+             (int): The local user id number, or None if the user wasn't
+                migrated
+        """
+        return self.users.github_user_id(username)
+
+    def _get_model_id_by_suffix(self, suffix):
+        """
+        Get the local id for a migrated resource whose source_url ends
+        with the given suffix. Uses the reversed url side table created by
+        prepare_database.py if it's there, which turns the match into an
+        index range scan instead of a scan of migratable_resources.
+
+        Arguments:
+            suffix (str): The end of the github.com url
+        Returns:
+            (dict): The model_id for the resource, or None
         """
-        if not username in self._user_cache:
-            self.sc.execute("""SELECT model_id FROM migratable_resources
-WHERE guid='{}' AND source_url='https://github.com/{}'""".format(self.guid, username))
-            user_id = self.sc.fetchone()
-            self._user_cache[username] = user_id['model_id']
-        return self._user_cache[username]
+        if self.use_suffix_table:
+            return self.q.row('model_id_by_reversed_url', self.guids, suffix[::-1] + '%')
+        return self.q.row('model_id_by_url', self.guids, '%' + suffix)
 
     def _get_local_issue_event_id(self, issue_id, event_id):
         """
@@ -107,24 +243,9 @@ WHERE guid='{}' AND source_url='https://github.com/{}'""".format(self.guid, user
         Returns:
              (int): The local issue event id
         """
-        self.sc.execute("""SELECT model_id FROM migratable_resources
-WHERE guid='{}' AND source_url like '%{}#event-{}'""".format(self.guid, issue_id, event_id))
-        evid = self.sc.fetchone()
+        evid = self._get_model_id_by_suffix('{}#event-{}'.format(issue_id, event_id))
         return evid['model_id']
 
-    def _get_last_row(self, table):
-        """
-        Get the id of the last row inserted into a table
-        
-        Arguments:
-            table (str): The name of the table
-        Returns:
-            (int): The id of the last row
-        """
-        self.ic.execute("SELECT max(id) FROM {}".format(table))
-        new_row = self.ic.fetchone()
-        return new_row[0]
-
     def _get_migrated_organization(self):
         """
         Get the name of the migrated organization. If more than one
@@ -135,11 +256,9 @@ WHERE guid='{}' AND source_url like '%{}#event-{}'""".format(self.guid, issue_id
             (str): The name of the migrated organization
         """
         try:
-            self.sc.execute("""SELECT id, login FROM users
-WHERE id=(SELECT model_id FROM migratable_resources WHERE model_name='organization')""")
+            return self.q.row('migrated_org', self.guids)
         except mysql.OperationalError:
             return None
-        return self.sc.fetchone()
 
     def get_local_comment_id(self, comment_id):
         """
@@ -151,9 +270,7 @@ WHERE id=(SELECT model_id FROM migratable_resources WHERE model_name='organizati
         Returns:
             (int): The local id for the comment record
         """
-        self.sc.execute("""SELECT model_id FROM migratable_resources
-WHERE guid='{}' AND source_url like '%{}'""".format(self.guid, comment_id))
-        ans = self.sc.fetchone()
+        ans = self._get_model_id_by_suffix(str(comment_id))
         return ans['model_id']
 
     def get_local_userid(self, username):
@@ -165,9 +282,7 @@ WHERE guid='{}' AND source_url like '%{}'""".format(self.guid, comment_id))
         Returns:
             (int): User id
         """
-        self.ic.execute("SELECT id FROM users WHERE login='{}'".format(username))
-        userid = self.ic.fetchone()
-        return userid[0]
+        return self.users.local_user_id(username)
 
     def get_migrated_prs(self, repo_id):
         """
@@ -176,39 +291,32 @@ WHERE guid='{}' AND source_url like '%{}'""".format(self.guid, comment_id))
         Arguments:
             repo_id (int): The id for the repository
         Returns:
-            (list): The id, updated timestamp, and number for each pull request
+            (list): A records.PullRequest for each pull request
         """
-        # Reviews were added as a feature in mid-September of 2016, so any
-        # pull requests that were merged before then can be safely ignored as
-        # having no reviews. For extra care we're setting the cutoff at
-        # 1 September 2016
-        threshold = dt(2016, 9, 1, 12, 0, 0)
+        return self.q.records('migrated_prs', PullRequest, repo_id, REVIEW_CUTOFF)
 
-        self.sc.execute("""SELECT pr.id, pr.updated_at, i.number FROM pull_requests pr, issues i
-WHERE pr.repository_id={} AND pr.updated_at>'{}' AND i.pull_request_id=pr.id
-ORDER BY i.number""".format(repo_id, threshold.isoformat()))
-        return self.sc.fetchall()
+    def get_reviewed_prs(self, repo_id, first=0, last=2 ** 31):
+        """
+        Get the pull requests that already have reviews, so each one can
+        be skipped on its own rather than resuming after the last one.
 
-    def get_last_migrated_review(self, repo_id):
+        Arguments:
+            repo_id (int): The id of the repository
+            first (int): The lowest pull request number to look at
+            last (int): The highest pull request number to look at
+        Returns:
+            (set): The numbers of the pull requests with reviews
+        """
+        return set(self.q.column('reviewed_prs', repo_id, first, last))
+
+    def has_reviews(self, pr_id):
         """
-        In case the process has to be restarted, we'll check for reviews
-        that have already been migrated and skip those.
-        
         Arguments:
-            repo_id (int): The id of the repo being migrated
+            pr_id (int): Local pull request id
         Returns:
-            (int): The id of the last pull request with migrated reviews for the give repo
-        """
-        self.ic.execute("""SELECT pull_request_id FROM pull_request_reviews
-WHERE id=(SELECT max(id) FROM pull_request_reviews
-WHERE pull_request_id IN (SELECT id FROM pull_requests WHERE repository_id='{}'))""".format(repo_id))
-        last_reviewed_id = self.ic.fetchone()
-        if last_reviewed_id:
-            self.ic.execute("""SELECT number from issues WHERE pull_request_id={}""".format(last_reviewed_id[0]))
-            last_reviewed_number = self.ic.fetchone()
-            return last_reviewed_number[0]
-        else:
-            return None
+            (bool): Whether the pull request has any reviews yet
+        """
+        return self.q.value('pr_has_reviews', pr_id) is not None
 
     def get_migrated_repositories(self):
         """
@@ -217,18 +325,35 @@ WHERE pull_request_id IN (SELECT id FROM pull_requests WHERE repository_id='{}')
         Returns:
              (list): The ids of the migrated repositories
         """
-        self.sc.execute("""SELECT id, name FROM repositories
-WHERE id in (SELECT model_id FROM migratable_resources
-WHERE guid='{}' AND model_name='repository')""".format(self.guid))
-        repos = self.sc.fetchall()
-        return repos
+        return self.q.rows('migrated_repositories', self.guids)
+
+    def get_repo_work_estimates(self):
+        """
+        Get the numbers needed to estimate how many API calls each migrated
+        repository is going to take. The branch count is the branches that
+        pull requests were opened against, which is where protection
+        settings are normally found.
+
+        Returns:
+            (list): The id, name, pull request count and branch count for
+                each migrated repository
+        """
+        return self.q.rows('repo_work_estimates', REVIEW_CUTOFF, self.guids)
+
+    def get_migration_status(self):
+        """
+        Count up the things the migration scripts add so it's easy to see
+        how far along a migration is.
+
+        Returns:
+            (dict): Counts of repositories, pull requests and what's been
+                migrated for them
+        """
+        g = self.guids
+        return self.q.row('migration_status', g, g, REVIEW_CUTOFF, g, g, g, g, g, g)
 
     def get_protected_branches(self, repo_id):
-        self.ic.execute("SELECT name FROM protected_branches WHERE repository_id={}".format(repo_id))
-        pb = []
-        for row in self.ic.fetchall():
-            pb.append(row[0])
-        return pb
+        return self.q.column('protected_branches', repo_id)
 
     def set_feature_options(self, repo_id, has_wiki, has_issues):
         """
@@ -239,23 +364,56 @@ WHERE guid='{}' AND model_name='repository')""".format(self.guid))
             has_wiki (bool): Whether or not the repository wiki is enabled
             has_issues (bool): Whether or not issues are enabled for the repo
         """
-        self.ic.execute("""UPDATE repositories SET has_wiki={}, has_issues={}
-WHERE id={}""".format('1' if has_wiki else '0',
-                      '1' if has_issues else '0',
-                      repo_id
-                      ))
-        self.m.commit()
+        self.q.run('set_feature_options', 1 if has_wiki else 0, 1 if has_issues else 0, repo_id)
+        self._commit()
 
-    def set_branch_protection(self, repo_id, user_id, branch):
+    def sync_repo_metadata(self):
+        """
+        Set the wiki and issues options and the pushed_at time for every
+        migrated repository in one go. The organization's repository list
+        is paged through once, 100 per page, and the settings are applied
+        with a single UPDATE joined against a staging table.
+
+        Returns:
+            (dict): The github.com repository objects from the listing,
+                keyed by name, so they don't need to be fetched again
+        """
+        import dateutil.parser
+
+        gh_repos = {}
+        rows = []
+        for gh_repo in per_page(self.gh.organization(self.org).repositories()):
+            gh_repos[gh_repo.name] = gh_repo
+            meta = repo_metadata(gh_repo)
+            rows.append((
+                meta['name'],
+                1 if meta['has_wiki'] else 0,
+                1 if meta['has_issues'] else 0,
+                dateutil.parser.parse(meta['pushed_at'], ignoretz=True) if meta['pushed_at'] else None,
+            ))
+
+        # The connection is shared with whatever runs next, so the staging
+        # table mustn't outlive this, even if the update fails
+        self.q.run('drop_metadata_staging')
+        self.q.run('create_metadata_staging')
+        try:
+            self.q.many('stage_repo_metadata', rows)
+            self.q.run('sync_repo_metadata', self.guids)
+            self.m.commit()
+        finally:
+            self.q.run('drop_metadata_staging')
+        return gh_repos
+
+    def set_branch_protection(self, repo_id, user_id, branch_name, protection):
         """
         Set protection options for the given branch
         
         Arguments:
             repo_id (int): Local repository ID
             user_id (int): Local id of the user performing the migration
-            branch (object): GitHub branch object
+            branch_name (str): Name of the branch
+            protection (dict): Full protection settings from github.com
         """
-        protection = branch.protection_full()
         sc_enforcement = 0
         sc_strict = 0
         rev_enforcement = 0
@@ -268,48 +426,17 @@ WHERE id={}""".format('1' if has_wiki else '0',
             rev_enforcement = 2 if protection['required_pull_request_reviews']['include_admins'] else 1
         if 'restrictions' in protection:
             authorized_actors = 1
-        self.ic.execute("""INSERT INTO protected_branches
-(repository_id, name, created_at, updated_at, creator_id,
-required_status_checks_enforcement_level, strict_required_status_checks_policy,
-authorized_actors_only, pull_request_reviews_enforcement_level)
-VALUES({0}, '{1}', '{2}', '{2}', {3}, {4}, {5}, {6}, {7})""".format(
-            repo_id,
-            branch.name,
-            dt.now(),
-            user_id,
-            sc_enforcement,
-            sc_strict,
-            authorized_actors,
-            rev_enforcement
-        ))
-        new_pb_id = self._get_last_row('protected_branches')
+        now = dt.now()
+        new_pb_id = self.q.insert('insert_protected_branch', repo_id, branch_name, now, now, user_id,
+                                  sc_enforcement, sc_strict, authorized_actors, rev_enforcement)
         if sc_enforcement:
-            for c in protection['required_status_checks']['contexts']:
-                self.ic.execute("""INSERT INTO required_status_checks
-(protected_branch_id, context, created_at, updated_at)
-VALUES({0}, '{1}', '{2}', '{2}')""".format(
-                    new_pb_id,
-                    c,
-                    dt.now(),
-                ))
+            self.q.many('insert_status_check',
+                        [(new_pb_id, c, now, now) for c in protection['required_status_checks']['contexts']])
         if authorized_actors:
-            for team in protection['restrictions']['teams']:
-                self.ic.execute("""INSERT INTO abilities
-(action, actor_id, actor_type, created_at, parent_id, priority, subject_id, subject_type, updated_at)
-VALUES(1, {0}, 'Team', '{1}', 0, 1, {2}, 'ProtectedBranch', '{1}')""".format(
-                    team['id'],
-                    dt.now(),
-                    new_pb_id,
-                ))
-            for user in protection['restrictions']['users']:
-                self.ic.execute("""INSERT INTO abilities
-(action, actor_id, actor_type, created_at, parent_id, priority, subject_id, subject_type, updated_at)
-VALUES(1, {0}, 'User', '{1}', 0, 1, {2}, 'ProtectedBranch', '{1}')""".format(
-                    user['id'],
-                    dt.now(),
-                    new_pb_id,
-                ))
-        self.m.commit()
+            self.q.many('insert_ability',
+                        [(team['id'], 'Team', now, new_pb_id, now) for team in protection['restrictions']['teams']] +
+                        [(user['id'], 'User', now, new_pb_id, now) for user in protection['restrictions']['users']])
+        self._commit()
 
     def set_comments_active(self, repo_id):
         """
@@ -318,9 +445,8 @@ VALUES(1, {0}, 'User', '{1}', 0, 1, {2}, 'ProtectedBranch', '{1}')""".format(
         Arguments:
             repo_id (int): Local repository id
         """
-        self.ic.execute("""UPDATE pull_request_review_comments SET state=1
-WHERE repository_id={} AND state=0""".format(repo_id))
-        self.m.commit()
+        self.q.run('set_comments_active', repo_id)
+        self._commit()
 
     def set_repo_pushed(self, repo_id, pushed_at):
         """
@@ -330,69 +456,145 @@ WHERE repository_id={} AND state=0""".format(repo_id))
             repo_id (int): Local repository id
             pushed_at (datetime.datetime): Timestamp
         """
-        self.ic.execute("UPDATE repositories SET pushed_at='{}' WHERE id={}".format(pushed_at, repo_id))
-        self.m.commit()
+        self.q.run('set_repo_pushed', pushed_at, repo_id)
+        self._commit()
 
-    def add_review(self, pr_number, review, gh_pr):
+    def local_review(self, pr_id, review):
+        """
+        Convert a review as returned by github_data.pr_reviews into the
+        local ids and values that add_review needs.
+
+        Arguments:
+            pr_id (int): Local pull request id
+            review (records.Review): The github.com review data
+        Returns:
+            (records.LocalReview): Contents of the review
+        """
+        import dateutil.parser
+
+        comment_ids = id_array()
+        for c in review.comments:
+            # This is a little fudge factor for testing the migration.
+            # During the final migration the repositories on github.com
+            # should be locked, so no updates will take place. During
+            # testing the repositories won't be locked so you can easily
+            # run into the situation where a comment will be added after
+            # the migration archive was created and so there won't be a
+            # local id for it.
+            try:
+                comment_ids.append(self.get_local_comment_id(c))
+            except TypeError:
+                continue
+        return LocalReview(
+            review.id,
+            pr_id,
+            self._get_user_id(review.user),
+            self.review_states[review.state],
+            review.commit_id,
+            review.body,
+            dateutil.parser.parse(review.submitted_at, ignoretz=True),
+            'markdown' if len(review.body) > 0 else None,
+            comment_ids,
+        )
+
+    def add_review(self, pr_number, review, dismissals=None):
         """
         Add the provided review to a local pull request.
         
         Arguments:
             pr_number (int): Local pull request number
-            review (dict): Contents of the review
-            gh_pr (github3.pulls.PullRequest): The github.com pull request object
-        """
-        self.ic.execute("""INSERT INTO pull_request_reviews
-(pull_request_id, user_id, state, head_sha, body, created_at, updated_at, submitted_at, formatter)
-VALUES({0}, {1}, {2}, '{3}', '{4}', '{5}', '{5}', '{5}', {6})""".format(
-            review['pull_request_id'],
-            review['user_id'],
-            review['state'],
-            review['head_sha'],
-            self.m.escape_string(codecs.encode(review['body'], 'utf-8')),
-            review['submitted_at'],
-            review['formatter']
-        ))
-        if len(review['comment_id']) > 0:
-            new_row = self._get_last_row('pull_request_reviews')
-            for c in review['comment_id']:
-                self.ic.execute("""UPDATE pull_request_review_comments
-SET pull_request_review_id={} WHERE id={}""".format(new_row, c))
+            review (records.LocalReview): Contents of the review
+            dismissals (list): Review dismissal events for the pull request,
+                as returned by github_data.review_dismissals
+        """
+        new_row = self.q.insert('insert_review',
+                                review.pull_request_id,
+                                review.user_id,
+                                review.state,
+                                review.head_sha,
+                                review.body,
+                                review.submitted_at,
+                                review.submitted_at,
+                                review.submitted_at,
+                                review.formatter)
+        self.q.many('link_review_comment', [(new_row, c) for c in review.comment_ids])
         # APPROVED and CHANGES_REQUESTED reviews need to have the
         # user removed from the review request list so that the
         # green check mark or the red x show up in the reviewers
         # list next to the name.
-        if review['state'] == 30 or review['state'] == 40:
-            self.sc.execute("""SELECT id, updated_at FROM review_requests
-WHERE pull_request_id={} AND reviewer_id={}""".format(review['pull_request_id'], review['user_id']))
-            review_request = self.sc.fetchone()
+        if review.state == 30 or review.state == 40:
+            review_request = self.q.row('review_request', review.pull_request_id, review.user_id)
             # If the review is newer than the review request, remove the
             # user from the list. Otherwise they were requested to review
             # again after they submitted this one so we leave them alone.
-            if review_request and review['submitted_at'] > review_request['updated_at']:
-                self.ic.execute("DELETE FROM review_requests WHERE id={}".format(review_request['id']))
+            if review_request and review.submitted_at > review_request['updated_at']:
+                self.q.run('delete_review_request', review_request['id'])
         # State 50 == DISMISSED and is a special case that requires
         # a little extra handling beyond just adding it to the
         # table.
-        if review['state'] == 50:
-            new_row = self._get_last_row('pull_request_reviews')
-            pr_issue = gh_pr.issue()
-            for e in pr_issue.events():
-                if getattr(e, 'dismissed_review', False):
-                    local_event = self._get_local_issue_event_id(pr_number, e.id)
-                    self.ic.execute("""UPDATE issue_event_details
-SET pull_request_review_state_was={}, message='{}', pull_request_review_id={}
-WHERE issue_event_id={}""".format(
-                        e.dismissed_review['state'],
-                        self.m.escape_string(codecs.encode(e.dismissed_review['dismissal_message'], 'utf-8')),
-                        new_row,
-                        local_event
-                    ))
-        self.m.commit()
+        if review.state == 50 and dismissals:
+            for d in dismissals:
+                # Older API responses don't say which review was dismissed,
+                # in which case every dismissal event gets linked.
+                if d.review_id is not None and d.review_id != review.id:
+                    continue
+                local_event = self._get_local_issue_event_id(pr_number, d.event_id)
+                self.q.run('dismiss_review', d.state, d.message, new_row, local_event)
+        self._commit()
+
+    def migrate_pr_reviews(self, pr, reviews, dismissals=None):
+        """
+        Add all the reviews of a pull request, unless it already has
+        some. The check and the inserts go together so that when this is
+        run through UnitOfWork.run and replayed after a deadlock, the
+        replay looks again and doesn't write reviews another worker has
+        committed in the meantime.
+
+        Arguments:
+            pr (records.PullRequest): The local pull request
+            reviews (list): records.Review for each of its github.com reviews
+            dismissals (list): Review dismissal events for the pull request,
+                as returned by github_data.review_dismissals
+        Returns:
+            (int): The number of reviews added, 0 if it already had some
+        """
+        if self.has_reviews(pr.id):
+            return 0
+        added = 0
+        for r in reviews:
+            review = self.local_review(pr.id, r)
+            if review.user_id is None:
+                # The reviewer wasn't part of the migration, and a review
+                # with no user would break the pull request page
+                self.users.skipped(r.user, 'reviews', r.id)
+                continue
+            self.add_review(pr.number, review, dismissals)
+            added += 1
+        return added
 
     def add_local_fork(self, user, repo_name, ghe_url):
         """
-        Create a local fork of a repository for a user.
+        Create a local fork of a repository for the local account a
+        github.com user was migrated to.
+
+        Arguments:
+            user (str): github.com login of the fork owner
+            repo_name (str): The repository to fork
+            ghe_url (str): URL for the GitHub Enterprise instance
+        Returns:
+            (str): The local login the fork was created for, an "Unable to
+                create fork" message, or None if the user has no local
+                account
+        """
+        # Make sure there's a local user mapped from the github.com username
+        mapped = self.users.github_user(user)
+        if not mapped or not mapped[1]:
+            return None
+        return self.create_local_fork({'id': mapped[0], 'login': mapped[1]}, repo_name, ghe_url)
+
+    def create_local_fork(self, local_user, repo_name, ghe_url):
+        """
+        Create a local fork of a repository for a local user.
         
         Forks can only be created for the currently logged in user,
         so this function cheats something awful. It grabs the current
@@ -408,38 +610,31 @@ WHERE issue_event_id={}""".format(
         settings are replaced before bailing out.
         
         Arguments:
-            user (str): Local user
+            local_user (dict): The local user's id and login
             repo_name (str): The repository to fork
+            ghe_url (str): URL for the GitHub Enterprise instance
+        Returns:
+            (str): The local login, or an "Unable to create fork" message
         """
         temporary_crypt = '$2a$08$k4ctWb8QbKlZaCM0tb4/P.FDhQpZXCoa.v2tFIO25rXeOdKBPWDAe'
-        # Make sure there's a local user mapped from the github.com username
-        self.sc.execute("""SELECT id, login FROM users
-WHERE id=(SELECT model_id FROM migratable_resources WHERE source_url like '%{}')""".format(user))
-        local_user = self.sc.fetchone()
-        if not local_user:
-            return None
 
         # Get the user's password crypt and stash it away for later
-        self.ic.execute("SELECT bcrypt_auth_token FROM users WHERE login='{}'".format(local_user['login']))
-        original_crypt = self.ic.fetchone()
+        original_crypt = self.q.value('user_crypt', local_user['login'])
 
         # Replace the crypt with the one we can authenticate with.
-        self.ic.execute("UPDATE users SET bcrypt_auth_token='{}' WHERE login='{}'".format(temporary_crypt, local_user['login']))
+        self.q.run('set_user_crypt', temporary_crypt, local_user['login'])
 
         # Check to see if the user has two-factor auth enabled, and stash away the
         # record for later if they do.
-        self.sc.execute("""SELECT id, secret, recovery_secret as rs, recovery_used_bitfield as rub,
-user_id, created_at as ca, updated_at as ua, sms_number as sms, delivery_method as dm,
-backup_sms_number as bsms, recovery_codes_viewed as rcv, provider
-FROM two_factor_credentials WHERE user_id={}""".format(local_user['id']))
-        user_2fa = self.sc.fetchone()
+        user_2fa = self.q.row('two_factor', local_user['id'])
         if user_2fa:
-            self.ic.execute("DELETE FROM two_factor_credentials WHERE id={}".format(user_2fa['id']))
+            self.q.run('delete_two_factor', user_2fa['id'])
         self.m.commit()
 
         try:
             # This totally assumes a self-signed certificate
             ghe_verify = '/etc/haproxy/ssl.crt' if ghe_url.startswith('https') else None
+            import github3
             ghe = github3.github.GitHubEnterprise(ghe_url, verify=ghe_verify)
             # Whee, login as the migrated local user and create them up a fork
             ghe.login(local_user['login'], 'migr8ion')
@@ -448,25 +643,23 @@ FROM two_factor_credentials WHERE user_id={}""".format(local_user['id']))
             ghe.session.close()
 
             # Reset their password crypt back to the original
-            self.ic.execute("UPDATE users SET bcrypt_auth_token='{}' WHERE login='{}'".format(original_crypt[0], local_user['login']))
+            self.q.run('set_user_crypt', original_crypt, local_user['login'])
 
             # If they had two-factor auth enabled, set that back up too
             if user_2fa:
-                self.ic.execute("""INSERT INTO two_factor_credentials
-VALUES({}, '{}', '{}', {}, {}, '{}', '{}', {}, '{}', {}, {}, {})""".format(
-                    user_2fa['id'],
-                    user_2fa['secret'],
-                    user_2fa['rs'],
-                    user_2fa['rub'],
-                    user_2fa['user_id'],
-                    user_2fa['ca'],
-                    user_2fa['ua'],
-                    "'{}'".format(user_2fa['sms']) if user_2fa['sms'] else 'NULL',
-                    user_2fa['dm'],
-                    "'{}'".format(user_2fa['bsms']) if user_2fa['bsms'] else 'NULL',
-                    user_2fa['rcv'],
-                    "'{}'".format(user_2fa['provider']) if user_2fa['provider'] else 'NULL',
-                ))
+                self.q.run('restore_two_factor',
+                           user_2fa['id'],
+                           user_2fa['secret'],
+                           user_2fa['rs'],
+                           user_2fa['rub'],
+                           user_2fa['user_id'],
+                           user_2fa['ca'],
+                           user_2fa['ua'],
+                           user_2fa['sms'] or None,
+                           user_2fa['dm'],
+                           user_2fa['bsms'] or None,
+                           user_2fa['rcv'],
+                           user_2fa['provider'] or None)
             self.m.commit()
             return local_user['login']
         except Exception as e:
@@ -475,24 +668,22 @@ VALUES({}, '{}', '{}', {}, {}, '{}', '{}', {}, '{}', {}, {}, {})""".format(
             # auth back to the original.
 
             # Reset their password crypt back to the original
-            self.ic.execute("UPDATE users SET bcrypt_auth_token='{}' WHERE login='{}'".format(original_crypt[0], local_user['login']))
+            self.q.run('set_user_crypt', original_crypt, local_user['login'])
 
             # If they had two-factor auth enabled, set that back up too
             if user_2fa:
-                self.ic.execute("""INSERT INTO two_factor_credentials
-VALUES({}, '{}', '{}', {}, {}, '{}', '{}', {}, '{}', {}, {}, {})""".format(
-                    user_2fa['id'],
-                    user_2fa['secret'],
-                    user_2fa['rs'],
-                    user_2fa['rub'],
-                    user_2fa['user_id'],
-                    user_2fa['ca'],
-                    user_2fa['ua'],
-                    "'{}'".format(user_2fa['sms']) if user_2fa['sms'] else 'NULL',
-                    user_2fa['dm'],
-                    "'{}'".format(user_2fa['bsms']) if user_2fa['bsms'] else 'NULL',
-                    user_2fa['rcv'],
-                    "'{}'".format(user_2fa['provider']) if user_2fa['provider'] else 'NULL',
-                ))
+                self.q.run('restore_two_factor',
+                           user_2fa['id'],
+                           user_2fa['secret'],
+                           user_2fa['rs'],
+                           user_2fa['rub'],
+                           user_2fa['user_id'],
+                           user_2fa['ca'],
+                           user_2fa['ua'],
+                           user_2fa['sms'] or None,
+                           user_2fa['dm'],
+                           user_2fa['bsms'] or None,
+                           user_2fa['rcv'],
+                           user_2fa['provider'] or None)
             self.m.commit()
             return "Unable to create fork: {}".format(e.message)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python2.7
+
+# offline_snapshot.py
+#
+# The GitHub Enterprise appliance is the only place the MySQL database
+# can be reached from, but its access to github.com tends to be slow
+# and proxied, which makes complete_migrations.py and recreate_forks.py
+# painful to run there. This utility splits the work in two:
+#
+#   fetch - Runs anywhere with github.com access and no database. It
+#           pulls everything the other scripts need (feature options,
+#           pushed_at, branch protections, reviews and the comments
+#           that belong to them, review dismissals and fork owners) and
+#           streams it into a compressed snapshot archive.
+#   apply - Runs on the appliance with no github.com access at all and
+#           streams the archive into the database, so it only goes as
+#           fast as the database does and re-running it after a failed
+#           import doesn't cost any API quota.
+#
+# The archive is gzipped JSON lines, written as one gzip member per
+# repository and only ever appended to. Alongside it is an index file
+# with one JSON line per finished repository recording where its member
+# starts and ends and how many records it has. An interrupted fetch can
+# be re-run with the same archive and it will pick up with the next
+# repository that isn't in the index.
+
+import argparse
+import dateutil.parser
+import github_data
+import gzip
+import json
+import os
+from progress import ApiCounter, Progress, peak_memory
+from records import Dismissal, Review
+import sys
+
+
+class SnapshotWriter(object):
+    """
+    Appends repositories to a snapshot archive.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.index'
+        self.index = {}
+        end = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as idx:
+                for line in idx:
+                    entry = json.loads(line)
+                    self.index[entry['repo']] = entry
+                    end = max(end, entry['end'])
+        # Throw away anything a previous fetch wrote for a repository it
+        # didn't get to finish.
+        with open(self.path, 'ab') as f:
+            f.truncate(end)
+
+    def __contains__(self, repo):
+        return repo in self.index
+
+    def add_repo(self, repo, records):
+        """
+        Write all records for a repository as a new member of the archive
+        and add it to the index.
+
+        Arguments:
+            repo (str): The repository name
+            records (iterable): The dicts to write for the repository
+        Returns:
+            (dict): The index entry for the repository
+        """
+        count = 0
+        with open(self.path, 'ab') as f:
+            start = f.tell()
+            gz = gzip.GzipFile(fileobj=f, mode='wb')
+            for record in records:
+                record['repo'] = repo
+                gz.write(json.dumps(record, separators=(',', ':')))
+                gz.write('\n')
+                count += 1
+            gz.close()
+            f.flush()
+            os.fsync(f.fileno())
+            end = f.tell()
+        entry = {'repo': repo, 'start': start, 'end': end, 'records': count}
+        with open(self.index_path, 'a') as idx:
+            idx.write(json.dumps(entry) + '\n')
+        self.index[repo] = entry
+        return entry
+
+
+class SnapshotReader(object):
+    """
+    Streams records back out of a snapshot archive.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        with open(path + '.index') as idx:
+            for line in idx:
+                self.entries.append(json.loads(line))
+
+    def repos(self):
+        """
+        Returns:
+            (list): The index entries, in the order they were fetched
+        """
+        return self.entries
+
+    def records(self, entry):
+        """
+        Read the records for one repository without decompressing
+        anything before it in the archive.
+
+        Arguments:
+            entry (dict): Index entry for the repository
+        Returns:
+            (generator): The records for the repository
+        """
+        with open(self.path, 'rb') as f:
+            f.seek(entry['start'])
+            gz = gzip.GzipFile(fileobj=f, mode='rb')
+            for _ in xrange(entry['records']):
+                yield json.loads(gz.readline())
+
+
+def repo_records(gh_repo, progress):
+    """
+    Pull everything we need for a repository from github.com.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+        progress (Progress): Progress display to count pull requests on
+    Returns:
+        (generator): Snapshot records for the repository
+    """
+    record = github_data.repo_metadata(gh_repo)
+    record['type'] = 'repo'
+    yield record
+
+    for name, protection in github_data.branch_protections(gh_repo):
+        yield {'type': 'protection', 'branch': name, 'protection': protection}
+
+    for gh_pr in github_data.per_page(gh_repo.pull_requests(state='all')):
+        progress.update()
+        if gh_pr.updated_at.replace(tzinfo=None) <= github_data.REVIEW_CUTOFF:
+            continue
+        reviews = github_data.pr_reviews(gh_pr)
+        if not reviews:
+            continue
+        dismissals = []
+        if any(r.state == 'DISMISSED' for r in reviews):
+            dismissals = github_data.review_dismissals(gh_pr)
+        yield {'type': 'pr', 'number': gh_pr.number,
+               'reviews': [r.as_dict() for r in reviews],
+               'dismissals': [d.as_dict() for d in dismissals]}
+
+    for owner in github_data.fork_owners(gh_repo):
+        yield {'type': 'fork', 'owner': owner}
+
+
+def fetch(gh, args):
+    """
+    Fetch the repositories named on the command line, or all of the
+    organization's repositories, into the snapshot archive.
+
+    Arguments:
+        gh (github3.GitHub): GitHub session
+        args (argparse.Namespace): Parsed command line arguments
+    """
+    api = ApiCounter.for_session(gh)
+    writer = SnapshotWriter(args.snapshot)
+
+    if args.repos:
+        gh_repos = (gh.repository(args.github_org, name) for name in args.repos)
+    else:
+        gh_repos = github_data.per_page(gh.organization(args.github_org).repositories())
+
+    for gh_repo in gh_repos:
+        if gh_repo.name in writer:
+            print "Repository {} ...Already fetched, skipping".format(gh_repo.name)
+            continue
+        print "Fetching repository {}".format(gh_repo.name)
+        progress = Progress('pull requests', api=api)
+        entry = writer.add_repo(gh_repo.name, repo_records(gh_repo, progress))
+        progress.finish("Done ({} records)".format(entry['records']))
+
+
+def apply_repo(mh, repo_id, records, user_id, ghe_url, total=None):
+    """
+    Apply the snapshot records for one repository to the local database.
+
+    Arguments:
+        mh (MigrationHelper): Helper connected to the local database
+        repo_id (int): Local repository id
+        records (iterable): Snapshot records for the repository
+        user_id (int): Local id of the user performing the migration
+        ghe_url (str): URL of the GitHub Enterprise instance, or None to
+            skip recreating forks
+        total (int): Number of records, for the progress display
+    """
+    already_protected = mh.get_protected_branches(repo_id)
+    local_prs = dict((pr.number, pr) for pr in mh.get_migrated_prs(repo_id))
+    # Pull request records are in github.com's order (newest first), and
+    # a failed apply can stop anywhere, so check each one
+    reviewed_prs = mh.get_reviewed_prs(repo_id)
+    pushed_at = None
+    progress = Progress('records', total=total)
+
+    with mh.unit_of_work() as uow:
+        for record in records:
+            progress.update()
+            if record['type'] == 'repo':
+                uow.run(mh.set_feature_options, repo_id, record['has_wiki'], record['has_issues'])
+                pushed_at = record['pushed_at']
+            elif record['type'] == 'protection':
+                if record['branch'] not in already_protected:
+                    progress.log("- Branch: {}".format(record['branch']))
+                    uow.run(mh.set_branch_protection, repo_id, user_id, record['branch'], record['protection'])
+            elif record['type'] == 'pr':
+                pr = local_prs.get(record['number'])
+                if not pr or pr.number in reviewed_prs:
+                    continue
+                dismissals = [Dismissal.from_dict(d) for d in record['dismissals']]
+                uow.run(mh.migrate_pr_reviews, pr, [Review.from_dict(r) for r in record['reviews']], dismissals)
+            elif record['type'] == 'fork' and ghe_url:
+                # Creating a fork commits the credential swap itself, so
+                # get everything before it committed first
+                uow.commit()
+                local_username = mh.add_local_fork(record['owner'], record['repo'], ghe_url)
+                if not local_username:
+                    progress.log("- Could not find local username for {}, no fork created".format(record['owner']))
+            # Every record is a whole pull request (or branch, or setting)
+            # so it's always safe to commit between them
+            uow.checkpoint()
+
+    mh.set_comments_active(repo_id)
+    if pushed_at:
+        mh.set_repo_pushed(repo_id, dateutil.parser.parse(pushed_at, ignoretz=True))
+    progress.finish("Done")
+
+
+def apply(mh, args):
+    """
+    Apply the snapshot archive to the local database.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        args (argparse.Namespace): Parsed command line arguments
+    """
+    reader = SnapshotReader(args.snapshot)
+    local_repos = dict((r['name'], r['id']) for r in mh.get_migrated_repositories())
+    user_id = mh.get_local_userid(args.ghe_user)
+
+    for entry in reader.repos():
+        if args.repos and entry['repo'] not in args.repos:
+            continue
+        if entry['repo'] not in local_repos:
+            print "Repository {} ...Not part of this migration, skipping".format(entry['repo'])
+            continue
+        print "Applying snapshot for repository {}".format(entry['repo'])
+        apply_repo(mh, local_repos[entry['repo']], reader.records(entry), user_id, args.ghe_url, entry['records'])
+
+    print mh.users.stats()
+    print peak_memory()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+
+    fetch_parser = subparsers.add_parser('fetch', help="Fetch github.com data into a snapshot archive.")
+    userauth = fetch_parser.add_mutually_exclusive_group(required=True)
+    userauth.add_argument(
+        '-t', '--token',
+        action='store',
+        dest='github_token',
+        help="GitHub OAuth token to use for authentication."
+    )
+    userauth.add_argument(
+        '-u', '--username',
+        action='store',
+        dest='github_username',
+        help="GitHub username."
+    )
+    userpass = fetch_parser.add_mutually_exclusive_group()
+    userpass.add_argument(
+        '-p', '--password',
+        action='store',
+        dest='github_password',
+        help="GitHub password."
+    )
+    userpass.add_argument(
+        '-P',
+        action='store_true',
+        dest='prompt_for_password',
+        help="Prompt for password instead of supplying it on the command line."
+    )
+    fetch_parser.add_argument(
+        '-2', '--two-factor',
+        action='store_true',
+        dest='github_two_factor',
+        help="Account requires 2-Factor authentication to access GitHub."
+    )
+    fetch_parser.add_argument(
+        '-o', '--organization',
+        action='store',
+        required=True,
+        dest='github_org',
+        help="The GitHub organization being migrated."
+    )
+
+    apply_parser = subparsers.add_parser('apply', help="Apply a snapshot archive to the local database.")
+    apply_parser.add_argument(
+        '-g',
+        action='append',
+        required=True,
+        dest='migration_guid',
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
+    )
+    apply_parser.add_argument(
+        '-o', '--organization',
+        action='store',
+        dest='github_org',
+        help="The GitHub organization being migrated."
+    )
+    apply_parser.add_argument(
+        '-l', '--local-user',
+        action='store',
+        required=True,
+        dest='ghe_user',
+        help="Your GitHub Enterprise username."
+    )
+    apply_parser.add_argument(
+        '-E', '--ghe-url',
+        action='store',
+        dest='ghe_url',
+        help="URL for your GitHub Enterprise instance. Forks are only recreated when this is given."
+    )
+
+    for p in (fetch_parser, apply_parser):
+        p.add_argument(
+            '-f', '--file',
+            action='store',
+            required=True,
+            dest='snapshot',
+            help="Path to the snapshot archive."
+        )
+        p.add_argument(
+            'repos',
+            nargs='*',
+            help="Only fetch or apply these repositories."
+        )
+
+    args = parser.parse_args()
+    if args.command == 'fetch':
+        if args.github_username:
+            if not args.github_password and not args.prompt_for_password:
+                parser.error("When using a username to login, you must use either -p to supply a password or -P to prompt for your password.")
+        fetch(github_data.github_login(args), args)
+    else:
+        # Imported here so that fetch works on machines without MySQLdb
+        from migration_helper import MigrationHelper
+
+        mh = MigrationHelper(args)
+        if not mh.org:
+            parser.error("Unable to determine migrated organization name, please specify it with the -o option.")
+        apply(mh, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python2.7
+
+# prepare_database.py
+#
+# Nearly every lookup the migration scripts do goes through the
+# migratable_resources table, which on a big import is one of the
+# largest tables in the database and isn't indexed for the way we use
+# it. The worst offenders are the lookups that match on the end of the
+# source_url (comments and issue events), which can't use an index at
+# all and so scan the whole table every time.
+#
+# Running `prepare` before the other scripts creates:
+#   - Indexes on migratable_resources for (guid, model_name, model_id)
+#     and (guid, source_url) so the joins against it are covered.
+#   - A side table with each resource's source_url reversed, so that
+#     a "source_url ends with" match becomes an index range scan on the
+#     start of the reversed url.
+#
+# MigrationHelper uses the side table automatically when it's been
+# populated for all of the migration GUIDs it's working on. Once the migration is complete,
+# `cleanup` drops everything that `prepare` created.
+
+import argparse
+from database import connect, resolve_guids
+import sys
+
+SUFFIX_TABLE = 'ghe_migration_url_suffixes'
+
+INDEXES = {
+    'ghe_migration_guid_model': 'migratable_resources (guid, model_name, model_id)',
+    'ghe_migration_guid_url': 'migratable_resources (guid, source_url(255))',
+}
+
+
+def _index_exists(ic, table, name):
+    ic.execute("""SELECT COUNT(*) FROM information_schema.statistics
+WHERE table_schema=DATABASE() AND table_name=%s AND index_name=%s""", (table, name))
+    return ic.fetchone()[0] > 0
+
+
+def suffix_table_ready(ic, guids):
+    """
+    Check whether the reversed url side table has been populated for
+    every one of a set of migrations.
+
+    Arguments:
+        ic (cursor): Database cursor
+        guids (list): The migration GUIDs
+    Returns:
+        (bool): True if suffix lookups can use the side table
+    """
+    ic.execute("SHOW TABLES LIKE %s", (SUFFIX_TABLE,))
+    if not ic.fetchone():
+        return False
+    guids = sorted(set(guids))
+    if not guids:
+        return False
+    ic.execute("SELECT COUNT(DISTINCT guid) FROM {} WHERE guid IN ({})".format(SUFFIX_TABLE, ', '.join(['%s'] * len(guids))),
+               guids)
+    return ic.fetchone()[0] == len(guids)
+
+
+def prepare(m, guids):
+    """
+    Create the helper indexes and populate the side table for a set of
+    migrations. Safe to run more than once.
+
+    Arguments:
+        m (connection): Database connection
+        guids (list): The migration GUIDs
+    """
+    ic = m.cursor()
+    for name, definition in sorted(INDEXES.items()):
+        if _index_exists(ic, 'migratable_resources', name):
+            print "Index {} already exists".format(name)
+            continue
+        print "Creating index {} on {}".format(name, definition)
+        ic.execute("CREATE INDEX {} ON {}".format(name, definition))
+
+    ic.execute("""CREATE TABLE IF NOT EXISTS {} (
+guid varchar(36) NOT NULL,
+reversed_url varchar(255) NOT NULL,
+model_name varchar(64) NOT NULL,
+model_id int(11) NOT NULL,
+KEY index_on_guid_and_reversed_url (guid, reversed_url)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8""".format(SUFFIX_TABLE))
+
+    for guid in guids:
+        if suffix_table_ready(ic, [guid]):
+            print "Suffix table already populated for {}".format(guid)
+            continue
+        print "Populating suffix table for {}".format(guid)
+        # Lookups match the start of the reversed url (the end of the url)
+        # against a short suffix, so cutting long urls down to the column
+        # size keeps every match exact. Without it a single long url would
+        # fail the whole insert under strict SQL mode.
+        ic.execute("""INSERT INTO {} (guid, reversed_url, model_name, model_id)
+SELECT guid, LEFT(REVERSE(source_url), 255), model_name, model_id FROM migratable_resources
+WHERE guid=%s""".format(SUFFIX_TABLE), (guid,))
+        m.commit()
+    ic.close()
+
+
+def cleanup(m):
+    """
+    Drop the helper indexes and the side table.
+
+    Arguments:
+        m (connection): Database connection
+    """
+    ic = m.cursor()
+    for name in sorted(INDEXES):
+        if _index_exists(ic, 'migratable_resources', name):
+            print "Dropping index {}".format(name)
+            ic.execute("DROP INDEX {} ON migratable_resources".format(name))
+    print "Dropping table {}".format(SUFFIX_TABLE)
+    ic.execute("DROP TABLE IF EXISTS {}".format(SUFFIX_TABLE))
+    ic.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    prepare_parser = subparsers.add_parser('prepare', help="Create the helper indexes and side table.")
+    prepare_parser.add_argument(
+        '-g',
+        action='append',
+        required=True,
+        dest='migration_guid',
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
+    )
+    subparsers.add_parser('cleanup', help="Drop the helper indexes and side table.")
+
+    args = parser.parse_args()
+    m = connect()
+    if args.command == 'prepare':
+        prepare(m, resolve_guids(m, args.migration_guid))
+    else:
+        cleanup(m)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
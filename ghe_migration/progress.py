@@ -0,0 +1,184 @@
+#!/usr/bin/env python2.7
+
+# progress.py
+#
+# Progress reporting for the migration scripts. Writing to the terminal
+# for every row processed adds up to a lot of system calls (and a lot of
+# traffic over SSH) on a large migration, so updates are only written
+# once per interval no matter how often the counters change.
+#
+# On a terminal the status is redrawn in place. When the output isn't a
+# terminal (redirected to a file, running under nohup, etc.) a plain
+# log line is written at a longer interval instead.
+
+import resource
+import sys
+import threading
+import time
+
+
+class ApiCounter(object):
+    """
+    Counts the requests made through a github3.py session. Progress
+    displays take the difference from when they started, so one counter
+    per session is all that's needed.
+    """
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_session(cls, gh):
+        """
+        Get the counter for a GitHub session, attaching one the first time
+        so that phases run one after another don't pile up hooks.
+
+        Arguments:
+            gh (github3.GitHub): GitHub session
+        Returns:
+            (ApiCounter): The session's counter
+        """
+        counter = getattr(gh.session, 'api_counter', None)
+        if counter is None:
+            counter = gh.session.api_counter = cls().attach(gh)
+        return counter
+
+    def attach(self, gh):
+        """
+        Start counting the requests made by a GitHub session.
+
+        Arguments:
+            gh (github3.GitHub): GitHub session
+        Returns:
+            (ApiCounter): self
+        """
+        gh.session.hooks.setdefault('response', []).append(self._count)
+        return self
+
+    def _count(self, response, *args, **kwargs):
+        # Responses can come in on several threads at once
+        with self._lock:
+            self.calls += 1
+
+
+class Progress(object):
+    """
+    Throttled progress display with rates, percent done and ETA.
+    """
+    def __init__(self, label, total=None, api=None, interval=0.5, log_interval=30.0, stream=None):
+        """
+        Arguments:
+            label (str): What's being counted
+            total (int): How many rows there are, if known
+            api (ApiCounter): Counter to report API calls from
+            interval (float): Seconds between updates on a terminal
+            log_interval (float): Seconds between log lines otherwise
+            stream (file): Where to write, defaults to stdout
+        """
+        self.label = label
+        self.total = total
+        self.api = api
+        self.stream = stream or sys.stdout
+        self.tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.interval = interval if self.tty else log_interval
+        self.rows = 0
+        self.started = time.time()
+        self._api_start = api.calls if api else 0
+        self._next = self.started + self.interval
+        self._width = 0
+
+    def update(self, rows=1):
+        """
+        Count processed rows, redrawing the status if it's due.
+
+        Arguments:
+            rows (int): Number of rows processed since the last update
+        """
+        self.rows += rows
+        now = time.time()
+        if now >= self._next:
+            self._next = now + self.interval
+            self._write(self.status(now))
+
+    def status(self, now=None):
+        """
+        Returns:
+            (str): The current progress line
+        """
+        elapsed = max((now or time.time()) - self.started, 0.001)
+        rate = self.rows / elapsed
+        parts = []
+        if self.total:
+            parts.append("{}/{} {} ({:.0f}%)".format(self.rows, self.total, self.label,
+                                                      100.0 * self.rows / self.total))
+        else:
+            parts.append("{} {}".format(self.rows, self.label))
+        parts.append("{:.1f}/s".format(rate))
+        if self.api:
+            parts.append("{:.2f} API calls/s".format((self.api.calls - self._api_start) / elapsed))
+        if self.total and rate > 0 and self.rows < self.total:
+            parts.append("ETA {}".format(duration((self.total - self.rows) / rate)))
+        return ", ".join(parts)
+
+    def log(self, message):
+        """
+        Write a message without mangling the progress line.
+
+        Arguments:
+            message (str): The message
+        """
+        self._clear()
+        self.stream.write(message + '\n')
+        self.stream.flush()
+
+    def finish(self, message=None):
+        """
+        Write the final status.
+
+        Arguments:
+            message (str): Appended to the final status line
+        """
+        self._clear()
+        line = self.status()
+        if message:
+            line = "{} - {}".format(line, message)
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def _clear(self):
+        if self.tty and self._width:
+            self.stream.write('\r' + ' ' * self._width + '\r')
+            self._width = 0
+
+    def _write(self, line):
+        if self.tty:
+            self.stream.write('\r' + line.ljust(self._width))
+            self._width = len(line)
+        else:
+            self.stream.write("{} {}\n".format(time.strftime('%H:%M:%S'), line))
+        self.stream.flush()
+
+
+def peak_memory():
+    """
+    Returns:
+        (str): The most memory this process has used so far
+    """
+    # ru_maxrss is in kilobytes on Linux (and bytes on OS X, which the
+    # appliance isn't)
+    return "Peak memory: {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def duration(seconds):
+    """
+    Arguments:
+        seconds (float): A length of time
+    Returns:
+        (str): The time in hours and minutes, or minutes and seconds
+            when it's under an hour
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m".format(hours, minutes)
+    return "{}m{:02d}s".format(minutes, seconds)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python2.7
+
+# queries.py
+#
+# A small layer for running named, parameterized statements. Values are
+# always passed to the driver as parameters rather than formatted into
+# the SQL, so branch names, status check contexts and review bodies with
+# quotes in them can't break (or change) a statement, and a statement run
+# once per row is the same text every time.
+#
+# Each module keeps its statements in a dict of name -> SQL with %s
+# placeholders. A placeholder whose value is a list is expanded to one
+# placeholder per item, so "guid IN (%s)" works for any number of GUIDs.
+# The expanded SQL is cached per statement and list length, and the
+# cursors are created once and reused for every statement.
+#
+# MySQLdb has no support for server side prepared statements (it
+# interpolates parameters on the client), so the reuse happens here
+# instead: the same statement text, the same cursor, and executemany for
+# statements run for a batch of rows.
+
+import MySQLdb as mysql
+
+
+class Queries(object):
+    """
+    Runs the named statements of a module against a connection.
+    """
+    def __init__(self, m, statements):
+        """
+        Arguments:
+            m (connection): Database connection
+            statements (dict): Statement name -> SQL with %s placeholders
+        """
+        self.m = m
+        self.statements = statements
+        self._sql = {}
+        self.dc = m.cursor(mysql.cursors.DictCursor)
+        self.c = m.cursor()
+
+    def sql(self, name, params=()):
+        """
+        Get the SQL for a statement, with placeholders for list parameters
+        expanded.
+
+        Arguments:
+            name (str): Statement name
+            params (tuple): The parameters it will be run with
+        Returns:
+            (str): The SQL
+            (tuple): The parameters, with lists flattened
+        """
+        shape = tuple(len(p) if isinstance(p, (list, tuple, set, frozenset)) else None for p in params)
+        key = (name, shape)
+        sql = self._sql.get(key)
+        if sql is None:
+            sql = self.statements[name]
+            if any(n is not None for n in shape):
+                pieces = sql.split('%s')
+                out = [pieces[0]]
+                for n, piece in zip(shape, pieces[1:]):
+                    # An empty list can't match anything, but IN () is a
+                    # syntax error, so it becomes IN (NULL)
+                    out.append('%s' if n is None else (', '.join(['%s'] * n) or 'NULL'))
+                    out.append(piece)
+                sql = ''.join(out)
+            self._sql[key] = sql
+        flat = []
+        for p, n in zip(params, shape):
+            if n is None:
+                flat.append(p)
+            else:
+                flat.extend(p)
+        return sql, tuple(flat)
+
+    def _execute(self, cursor, name, params):
+        sql, args = self.sql(name, params)
+        cursor.execute(sql, args)
+        return cursor
+
+    def row(self, name, *params):
+        """
+        Returns:
+            (dict): The first row, or None
+        """
+        return self._execute(self.dc, name, params).fetchone()
+
+    def rows(self, name, *params):
+        """
+        Returns:
+            (list): A dict for each row
+        """
+        return self._execute(self.dc, name, params).fetchall()
+
+    def records(self, name, cls, *params):
+        """
+        Arguments:
+            name (str): Statement name
+            cls (class): The records.Record class to build, whose fields
+                are in the same order as the columns of the statement
+        Returns:
+            (list): A record for each row
+        """
+        return [cls(*row) for row in self._execute(self.c, name, params).fetchall()]
+
+    def value(self, name, *params):
+        """
+        Returns:
+            The first column of the first row, or None
+        """
+        row = self._execute(self.c, name, params).fetchone()
+        return row[0] if row else None
+
+    def column(self, name, *params):
+        """
+        Returns:
+            (list): The first column of every row
+        """
+        return [row[0] for row in self._execute(self.c, name, params).fetchall()]
+
+    def run(self, name, *params):
+        """
+        Run a statement that doesn't return rows.
+
+        Returns:
+            (int): The number of rows affected
+        """
+        return self._execute(self.c, name, params).rowcount
+
+    def insert(self, name, *params):
+        """
+        Run an INSERT.
+
+        Returns:
+            (int): The id of the new row
+        """
+        return self._execute(self.c, name, params).lastrowid
+
+    def many(self, name, rows):
+        """
+        Run a statement once for each set of parameters in one go. List
+        parameters aren't expanded here.
+
+        Arguments:
+            name (str): Statement name
+            rows (list): A tuple of parameters for each run
+        Returns:
+            (int): The number of times it was run
+        """
+        rows = list(rows)
+        if rows:
+            self.c.executemany(self.statements[name], rows)
+        return len(rows)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.7
+
+# records.py
+#
+# Compact records for the rows and API data the migration holds on to.
+# A dict per review, comment, event or database row (or a github3.py
+# object with all of its raw JSON) costs several hundred bytes before
+# holding any data. These use __slots__ so each one is a fixed size
+# object with only the fields add_review and the fix functions read, and
+# lists of ids are kept in arrays of machine integers.
+#
+# Records are built positionally from database rows (the columns of
+# the query must be in the order of __slots__) or by keyword, and can be
+# turned into plain dicts and back for the snapshot archive.
+
+from array import array
+
+
+class Record(object):
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name in self.__slots__[len(args):]:
+            setattr(self, name, kwargs.get(name))
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Arguments:
+            d (dict): The fields, as written by as_dict
+        Returns:
+            (Record): The record
+        """
+        return cls(**d)
+
+    def as_dict(self):
+        """
+        Returns:
+            (dict): The fields, with arrays turned into lists so the result
+                can be written as JSON
+        """
+        d = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            d[name] = value.tolist() if isinstance(value, array) else value
+        return d
+
+    def __repr__(self):
+        return "{}({})".format(self.__class__.__name__,
+                               ', '.join("{}={!r}".format(n, getattr(self, n)) for n in self.__slots__))
+
+
+def id_array(ids=()):
+    """
+    Arguments:
+        ids (iterable): Integer ids
+    Returns:
+        (array): The ids as an array of 64 bit integers
+    """
+    return array('l', ids)
+
+
+class Review(Record):
+    """
+    A pull request review as github.com has it. comments holds the ids
+    of the review comments that belong to it.
+    """
+    __slots__ = ('id', 'user', 'state', 'commit_id', 'body', 'submitted_at', 'comments')
+
+    @classmethod
+    def from_dict(cls, d):
+        review = cls(**d)
+        review.comments = id_array(review.comments or ())
+        return review
+
+
+class Dismissal(Record):
+    """
+    A review dismissal event from a pull request timeline.
+    """
+    __slots__ = ('event_id', 'review_id', 'state', 'message')
+
+
+class LocalReview(Record):
+    """
+    A review converted to local ids, ready for add_review.
+    """
+    __slots__ = ('id', 'pull_request_id', 'user_id', 'state', 'head_sha', 'body', 'submitted_at',
+                 'formatter', 'comment_ids')
+
+
+class PullRequest(Record):
+    """
+    A migrated pull request.
+    """
+    __slots__ = ('id', 'updated_at', 'number')
+
+
+class IssueTimes(Record):
+    """
+    The timestamps of an issue that set its place in contribution history.
+    """
+    __slots__ = ('id', 'updated_at', 'closed_at')
+
+
+class PullRequestTimes(Record):
+    """
+    The timestamps of a pull request that set its place in contribution
+    history.
+    """
+    __slots__ = ('id', 'created_at', 'merged_at')
+
+
+class Event(Record):
+    """
+    An assignment or review request event, with the issue it's on.
+    """
+    __slots__ = ('issue_id', 'pr', 'issue_user', 'event_id', 'event', 'actor', 'detail_id', 'subject', 'created')
@@ -15,14 +15,239 @@
 # have had in the github.com fork will need to be pushed to the
 # new GitHub Enterprise fork.
 #
+# Creating a fork is slow, so the work is split in two. First an
+# inventory of the forks of every migrated repository is taken from
+# github.com, several repositories at a time and 100 forks per page,
+# and cached in a JSON file so that running again (after fixing up some
+# users, or after an interruption) only lists the repositories that
+# aren't in it yet. Then every fork owner is resolved to a local user in
+# one go, giving a plan of (local user, repository) pairs without any
+# duplicates. Owners with no local account are reported before anything
+# is created, and the slow part only works through the plan.
+#
+# Given a site admin token (--admin-token), the forks are created with
+# an impersonation token for each user instead (see ghe_admin.py),
+# several users at a time, without touching anyone's credentials.
+#
 # 14 April 2017
 # Mark Troyer <disco@blackops.io>
 
 import argparse
+from collections import defaultdict
+from database import mark_finished
+import github_data
+import json
 from migration_helper import MigrationHelper
+from multiprocessing.pool import ThreadPool
+import os
+from progress import ApiCounter, Progress
 import sys
 
 
+def inventory_path(org):
+    """
+    Arguments:
+        org (str): The organization being migrated
+    Returns:
+        (str): Where the fork inventory is cached by default
+    """
+    return "forks-{}.json".format(org)
+
+
+def load_inventory(path, org):
+    """
+    Arguments:
+        path (str): The inventory file
+        org (str): The organization being migrated
+    Returns:
+        (dict): Repository name -> github.com logins of its fork owners,
+            empty if there's no inventory for the organization yet
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('org') != org:
+        print "Ignoring the fork inventory in {}, it's for {}".format(path, data.get('org'))
+        return {}
+    return data['repos']
+
+
+def save_inventory(path, org, repos):
+    """
+    Write the inventory, replacing the file in one go so an interrupted
+    write can't leave half of it behind.
+
+    Arguments:
+        path (str): The inventory file
+        org (str): The organization being migrated
+        repos (dict): Repository name -> github.com logins of its fork owners
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'org': org, 'repos': repos}, f, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def inventory_complete(mh, path):
+    """
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        path (str): The inventory file
+    Returns:
+        (bool): Whether every migrated repository is in the inventory
+            already, so the forks can be created without github.com
+    """
+    repos = load_inventory(path, mh.org)
+    return all(r['name'] in repos for r in mh.get_migrated_repositories())
+
+
+def take_inventory(mh, names, path, refresh=False, threads=8):
+    """
+    List the forks of the migrated repositories on github.com, several
+    repositories at a time, adding to the cached inventory.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        names (list): The migrated repository names
+        path (str): The inventory file
+        refresh (bool): List every repository again, even ones that are
+            already in the inventory
+        threads (int): How many repositories to list at once
+    Returns:
+        (dict): Repository name -> github.com logins of its fork owners
+    """
+    repos = {} if refresh else load_inventory(path, mh.org)
+    todo = [n for n in names if n not in repos]
+    if not todo:
+        print "Fork inventory: all {} repositories are in {}".format(len(names), path)
+        return repos
+
+    api = ApiCounter.for_session(mh.gh)
+    # The organization listing says how many forks each repository has,
+    # so the ones without any don't cost a call
+    gh_repos = dict((r.name, r) for r in github_data.per_page(mh.gh.organization(mh.org).repositories()))
+    print "Fork inventory: listing {} repositories ({} already in {})".format(len(todo), len(names) - len(todo), path)
+    progress = Progress('repositories', total=len(todo), api=api)
+
+    def list_forks(name):
+        gh_repo = gh_repos.get(name)
+        if gh_repo is None:
+            return name, None, "not found on github.com"
+        if getattr(gh_repo, 'forks_count', None) == 0:
+            return name, [], None
+        try:
+            return name, github_data.fork_owners(gh_repo), None
+        except Exception as e:
+            return name, None, str(e)
+
+    # The threads share the logged in github.com session rather than each
+    # logging in again, which with a password and two-factor auth would
+    # mean a prompt per thread. requests doesn't promise that a Session
+    # can be shared between threads, but these are only GETs with
+    # credentials that don't change after login, each listing keeps its
+    # paging state in its own iterator and the API counter takes a lock,
+    # so what's actually shared is the connection pool and cookie jar. If
+    # that ever causes trouble, --threads 1 lists one repository at a time.
+    pool = ThreadPool(threads)
+    try:
+        for name, owners, error in pool.imap_unordered(list_forks, todo):
+            progress.update()
+            if error:
+                # Left out of the inventory so the next run tries again
+                progress.log("Could not list the forks of {}: {}".format(name, error))
+            else:
+                repos[name] = owners
+    finally:
+        pool.terminate()
+        pool.join()
+        # Whatever was listed is kept, even if this was interrupted
+        save_inventory(path, mh.org, repos)
+    progress.finish("Done")
+    return repos
+
+
+def build_plan(users, repos):
+    """
+    Turn an inventory into the forks to create.
+
+    Arguments:
+        users (UserDirectory): The migration's user directory
+        repos (dict): Repository name -> github.com logins of its fork owners
+    Returns:
+        (list): The local user id, local login and repository name of
+            each fork to create, once each, grouped by user
+        (dict): github.com login -> the repositories it forked, for each
+            owner with no local account
+    """
+    users.resolve_github(set(owner for owners in repos.itervalues() for owner in owners))
+    plan = set()
+    unresolved = defaultdict(list)
+    for name in sorted(repos):
+        for owner in repos[name]:
+            mapped = users.github_user(owner)
+            if mapped and mapped[1]:
+                plan.add((mapped[0], mapped[1], name))
+            else:
+                unresolved[owner].append(name)
+    return sorted(plan, key=lambda f: (f[1].lower(), f[2])), dict(unresolved)
+
+
+def run(mh, ghe_url, inventory=None, refresh=False, threads=8, plan_only=False, admin_token=None,
+        api_url=None):
+    """
+    Recreate the forks of every migrated repository.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        ghe_url (str): URL for the GitHub Enterprise instance
+        inventory (str): Where to cache the fork inventory, defaults to
+            forks-<organization>.json
+        refresh (bool): List the forks of every repository again
+        threads (int): How many repositories to list, or users to create
+            forks for, at once
+        plan_only (bool): Stop after showing what would be created
+        admin_token (str): Site admin token to create the forks with
+            impersonation tokens, instead of swapping each user's password
+        api_url (str): API to create the forks through with admin_token,
+            instead of the instance's own
+    Returns:
+        (list): The forks that were (or would be) created
+    """
+    names = sorted(r['name'] for r in mh.get_migrated_repositories())
+    repos = take_inventory(mh, names, inventory or inventory_path(mh.org), refresh, threads)
+    plan, unresolved = build_plan(mh.users, dict((n, repos[n]) for n in names if n in repos))
+
+    if unresolved:
+        print "{} fork owners have no local account, so their forks won't be created:".format(len(unresolved))
+        for owner in sorted(unresolved, key=lambda o: o.lower()):
+            print "  {}: {}".format(owner, ', '.join(unresolved[owner]))
+    print "{} forks to create for {} users".format(len(plan), len(set(f[0] for f in plan)))
+    if plan_only:
+        return plan
+
+    progress = Progress('forks', total=len(plan))
+    if admin_token:
+        from ghe_admin import SiteAdmin
+        admin = SiteAdmin.for_ghe(ghe_url, admin_token, api_url)
+        forks_per_user = defaultdict(int)
+        for _, login, _ in plan:
+            forks_per_user[login] += 1
+        for login, forked, errors in admin.create_forks(mh.org, [(f[1], f[2]) for f in plan], threads):
+            for name, error in errors:
+                progress.log("User: {}{} - {}".format(login, " repository: {}".format(name) if name else '', error))
+            progress.update(forks_per_user[login])
+    else:
+        for user_id, login, name in plan:
+            result = mh.create_local_fork({'id': user_id, 'login': login}, name, ghe_url)
+            if result.startswith("Unable to create fork"):
+                progress.log("User: {} repository: {} - {}".format(login, name, result))
+            progress.update()
+    progress.finish("Done")
+
+    print mh.users.stats()
+    return plan
+
+
 def main():
     parser = argparse.ArgumentParser()
     userauth = parser.add_mutually_exclusive_group(required=True)
@@ -59,10 +284,10 @@ def main():
     )
     parser.add_argument(
         '-g',
-        action='store',
+        action='append',
         required=True,
         dest='migration_guid',
-        help="The GUID of the migration you're working on as set by ghe-migrator."
+        help="The GUID of the migration you're working on as set by ghe-migrator, or 'all' for every unfinished migration. Repeat it or separate GUIDs with commas for several."
     )
     parser.add_argument(
         '-o', '--organization',
@@ -77,6 +302,44 @@ def main():
         dest='ghe_url',
         help="URL for your GitHub Enterprise instance."
     )
+    parser.add_argument(
+        '--inventory',
+        action='store',
+        dest='fork_inventory',
+        help="Where to cache the list of forks. Defaults to forks-<organization>.json."
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        dest='refresh_forks',
+        help="List the forks of every repository again instead of using the cached list."
+    )
+    parser.add_argument(
+        '--threads',
+        action='store',
+        type=int,
+        default=8,
+        dest='fork_threads',
+        help="How many repositories to list forks for, or users to create forks for, at once. Defaults to 8."
+    )
+    parser.add_argument(
+        '--admin-token',
+        action='store',
+        dest='admin_token',
+        help="GitHub Enterprise site admin token. Forks are created with an impersonation token for each user instead of by swapping their password."
+    )
+    parser.add_argument(
+        '--api-url',
+        action='store',
+        dest='admin_api_url',
+        help="With --admin-token, create the forks through this API instead of the instance's own, for example the one fake_ghe.py serves."
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        dest='plan_only',
+        help="Only show which forks would be created."
+    )
 
     args = parser.parse_args()
     if args.github_username:
@@ -88,20 +351,10 @@ def main():
     if not migrator.org:
         parser.error("Unable to determine migrated organization name, please specify it with the -o option.")
 
-    migrated_repos = migrator.get_migrated_repositories()
-    for i in migrated_repos:
-        print "Recreating fork for repository {}".format(i['name'])
-        # Get the github.com version of the repo as an object
-        gh_repo = migrator.gh.repository(migrator.org, i['name'])
-
-        for fork in gh_repo.forks():
-            sys.stdout.write("User: {}".format(fork.owner.login))
-            sys.stdout.flush()
-            local_username = migrator.add_local_fork(fork.owner.login, i['name'], args.ghe_url)
-            if local_username:
-                print " ({})".format(local_username)
-            else:
-                print " ...Could not find local username for {}, no fork created".format(fork.owner.login)
+    run(migrator, args.ghe_url, args.fork_inventory, args.refresh_forks, args.fork_threads, args.plan_only,
+        args.admin_token, args.admin_api_url)
+    if not args.plan_only:
+        mark_finished(migrator.m, migrator.guids, 'forks')
 
 
 if __name__ == "__main__":
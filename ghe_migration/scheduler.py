@@ -0,0 +1,174 @@
+#!/usr/bin/env python2.7
+
+# scheduler.py
+#
+# Works out the order complete_migrations.py should process repositories
+# in and how long it's going to take, given that github.com only allows
+# 5000 API calls an hour.
+#
+# The cost of each repository is estimated up front from the local
+# pull request and branch counts, and as repositories are finished the
+# estimate is corrected using the measured number of calls per pull
+# request. The ETA takes into account both how fast calls are actually
+# being made and how many rate limit resets we'll have to sit through.
+
+import math
+from progress import duration
+import time
+
+# Calls made for every repository: listing branches and pull requests
+# plus a little slack for the odd retry.
+CALLS_PER_REPO = 3.0
+# Calls made for every pull request: the pull request itself, its
+# reviews and its review comments.
+CALLS_PER_PR = 3.0
+# Calls made for every branch that's protected.
+CALLS_PER_BRANCH = 1.0
+# Seconds to allow per call before we've measured anything. Includes
+# the sleeps complete_migrations.py does between pull requests.
+SECONDS_PER_CALL = 1.0
+RATE_LIMIT = 5000
+
+STRATEGIES = ('given', 'small-first', 'large-first', 'critical-first')
+
+
+class Scheduler(object):
+    """
+    Orders repositories and tracks progress against the API budget.
+    """
+    def __init__(self, repos, strategy='small-first', critical=None):
+        """
+        Arguments:
+            repos (list): Dicts with the id, name, prs and branches for
+                each repository, as returned by
+                MigrationHelper.get_repo_work_estimates
+            strategy (str): One of STRATEGIES
+            critical (list): Names of repositories to do first when using
+                the critical-first strategy
+        """
+        self.calls_per_pr = CALLS_PER_PR
+        self.seconds_per_call = SECONDS_PER_CALL
+        self._measured_prs = 0
+        self._measured_calls = 0
+        self._measured_seconds = 0.0
+        critical = set(critical or [])
+
+        if strategy == 'small-first':
+            key = lambda r: self.estimate(r)
+        elif strategy == 'large-first':
+            key = lambda r: -self.estimate(r)
+        elif strategy == 'critical-first':
+            key = lambda r: (r['name'] not in critical, self.estimate(r))
+        else:
+            key = None
+        self.pending = sorted(repos, key=key) if key else list(repos)
+        self.done = []
+
+    def estimate(self, repo):
+        """
+        Arguments:
+            repo (dict): The repository
+        Returns:
+            (float): Estimated API calls needed for the repository
+        """
+        return CALLS_PER_REPO + repo['branches'] * CALLS_PER_BRANCH + repo['prs'] * self.calls_per_pr
+
+    def remaining_calls(self):
+        """
+        Returns:
+            (int): Estimated API calls needed to finish all pending repositories
+        """
+        return int(sum(self.estimate(r) for r in self.pending))
+
+    def next_repo(self, remaining):
+        """
+        Take the next repository to work on. Goes in the order set by the
+        strategy, but if the next one won't fit in what's left of the
+        current rate limit window, a later one that does fit is taken
+        instead so the budget doesn't go to waste.
+
+        Arguments:
+            remaining (int): API calls left before the rate limit resets
+        Returns:
+            (dict): The repository, or None when everything is done
+        """
+        if not self.pending:
+            return None
+        pick = 0
+        if self.estimate(self.pending[0]) > remaining:
+            for i, r in enumerate(self.pending):
+                if self.estimate(r) <= remaining:
+                    pick = i
+                    break
+        return self.pending.pop(pick)
+
+    def finish(self, repo, calls, seconds):
+        """
+        Record that a repository has been finished and update the measured
+        costs with how it went.
+
+        Arguments:
+            repo (dict): The repository
+            calls (int): The API calls it actually used
+            seconds (float): How long it took, not counting any time spent
+                waiting for the rate limit to reset
+        """
+        self.done.append(repo)
+        self._measured_seconds += seconds
+        self._measured_calls += calls
+        self._measured_prs += repo['prs']
+        if self._measured_prs:
+            spent = self._measured_calls - CALLS_PER_REPO * len(self.done)
+            self.calls_per_pr = max(1.0, spent / float(self._measured_prs))
+        if self._measured_calls:
+            self.seconds_per_call = self._measured_seconds / self._measured_calls
+
+    def eta(self, remaining, reset):
+        """
+        Work out how long the pending repositories will take.
+
+        Arguments:
+            remaining (int): API calls left before the rate limit resets
+            reset (int): Epoch time of the next rate limit reset
+        Returns:
+            (float): Seconds until everything should be finished
+        """
+        needed = self.remaining_calls()
+        if needed <= remaining:
+            return needed * self.seconds_per_call
+        # We're going to run out. Count the time spent waiting for resets,
+        # then however long the calls after the last reset take.
+        windows = int(math.ceil((needed - remaining) / float(RATE_LIMIT)))
+        after_reset = needed - remaining - (windows - 1) * RATE_LIMIT
+        wait = max(reset - time.time(), remaining * self.seconds_per_call)
+        return wait + (windows - 1) * 3600 + after_reset * self.seconds_per_call
+
+    def report(self, remaining, reset):
+        """
+        Returns:
+            (str): Summary of where things stand
+        """
+        seconds = self.eta(remaining, reset)
+        return "{} repos left, ~{} API calls ({:.1f}/PR), {} left until {}. ETA {} ({})".format(
+            len(self.pending),
+            self.remaining_calls(),
+            self.calls_per_pr,
+            remaining,
+            time.strftime('%H:%M', time.localtime(reset)),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(time.time() + seconds)),
+            duration(seconds),
+        )
+
+
+def rate_limit(gh):
+    """
+    Get the state of the core API rate limit. Checking it doesn't count
+    against the limit.
+
+    Arguments:
+        gh (github3.GitHub): GitHub session
+    Returns:
+        (tuple): Calls remaining and epoch time of the next reset
+    """
+    core = gh.rate_limit()['resources']['core']
+    return core['remaining'], core['reset']
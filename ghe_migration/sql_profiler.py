@@ -0,0 +1,288 @@
+#!/usr/bin/env python2.7
+
+# sql_profiler.py
+#
+# Opt-in profiling of the SQL the migration scripts run. Once a Profiler
+# has been handed to database.enable_profiling(), every connection made
+# by database.connect() hands out cursors that time each statement.
+#
+# Statements are grouped by fingerprint: the SQL with quoted strings,
+# numbers and placeholders replaced by ? and IN lists and multi-row
+# VALUES collapsed, so the same query run for each of a million rows
+# shows up as one line. For each fingerprint the count, total time, 95th
+# percentile, slowest run and rows are kept, and the first time a run
+# goes over the slow threshold its EXPLAIN plan is captured on a separate
+# connection so it doesn't disturb the transaction or a streaming cursor.
+#
+# At the end of the run the top statements by total time are printed
+# and the full report is written as JSON so runs can be compared.
+
+import json
+import random
+import re
+import time
+
+# How many timings are kept per fingerprint to work out the percentile
+SAMPLE_SIZE = 1000
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|%\(\w+\)s')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+_VALUES = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+_SPACE = re.compile(r'\s+')
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|UPDATE|DELETE)\b', re.I)
+
+
+def fingerprint(sql):
+    """
+    Normalize a statement so that runs that only differ in their values
+    are grouped together.
+
+    Arguments:
+        sql (str): The statement
+    Returns:
+        (str): The fingerprint
+    """
+    fp = _STRING.sub('?', sql)
+    fp = _PLACEHOLDER.sub('?', fp)
+    fp = _NUMBER.sub('?', fp)
+    fp = _IN_LIST.sub('IN (?+)', fp)
+    fp = _VALUES.sub(r'\1', fp)
+    return _SPACE.sub(' ', fp).strip()
+
+
+class Stat(object):
+    """
+    Timings for one fingerprint.
+    """
+    def __init__(self, example):
+        self.example = example
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.fetch = 0.0
+        self.samples = []
+        self.explain = None
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows += max(rows, 0)
+        # Reservoir sample so the percentile holds up for statements that
+        # are run millions of times without keeping every timing
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(seconds)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < SAMPLE_SIZE:
+                self.samples[i] = seconds
+
+    def p95(self):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def as_dict(self, fp):
+        return {
+            'fingerprint': fp,
+            'example': self.example,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p95': self.p95(),
+            'max': self.max,
+            'rows': self.rows,
+            'fetch': self.fetch,
+            'explain': self.explain,
+        }
+
+
+class Profiler(object):
+    """
+    Collects statement timings from profiled cursors.
+    """
+    def __init__(self, output=None, threshold=0.5, top=20, explain_connect=None):
+        """
+        Arguments:
+            output (str): Where to write the JSON report, if anywhere
+            threshold (float): Seconds after which a statement is slow
+                and has its EXPLAIN plan captured
+            top (int): How many statements to print in the report
+            explain_connect (function): Opens the connection EXPLAIN is
+                run on. Set by database.enable_profiling()
+        """
+        self.output = output
+        self.threshold = threshold
+        self.top = top
+        self.explain_connect = explain_connect
+        self.stats = {}
+        self.started = time.time()
+        self._explain_db = None
+
+    def record(self, sql, seconds, rows, executed=None):
+        """
+        Record a run of a statement.
+
+        Arguments:
+            sql (str): The statement as passed to the cursor
+            seconds (float): How long it took
+            rows (int): Rows returned or affected
+            executed (str): The statement with its parameters filled in,
+                for EXPLAIN
+        Returns:
+            (str): The fingerprint of the statement
+        """
+        fp = fingerprint(sql)
+        stat = self.stats.get(fp)
+        if stat is None:
+            stat = self.stats[fp] = Stat(sql[:1000])
+        stat.add(seconds, rows)
+        if seconds >= self.threshold and stat.explain is None and executed:
+            stat.explain = self._explain(executed)
+        return fp
+
+    def record_fetch(self, fp, seconds, rows):
+        """
+        Add the time spent reading results from a streaming cursor to the
+        statement that produced them.
+        """
+        stat = self.stats.get(fp)
+        if stat is not None:
+            stat.fetch += seconds
+            stat.rows += rows
+
+    def _explain(self, sql):
+        if not _EXPLAINABLE.match(sql) or self.explain_connect is None:
+            return []
+        try:
+            if self._explain_db is None:
+                self._explain_db = self.explain_connect()
+            c = self._explain_db.cursor()
+            c.execute("EXPLAIN " + sql)
+            columns = [d[0] for d in c.description]
+            plan = [dict(zip(columns, [v if v is None or isinstance(v, (int, long, float)) else unicode(v)
+                                       for v in row]))
+                    for row in c.fetchall()]
+            c.close()
+            return plan
+        except Exception as e:
+            return [{'error': str(e)}]
+
+    def results(self):
+        """
+        Returns:
+            (list): A dict for each fingerprint, slowest total first
+        """
+        return sorted((s.as_dict(fp) for fp, s in self.stats.iteritems()),
+                      key=lambda r: r['total'] + r['fetch'], reverse=True)
+
+    def report(self):
+        """
+        Returns:
+            (str): The top statements by total time
+        """
+        results = self.results()
+        lines = ["SQL profile: {} statements, {} distinct, {:.1f}s in the database over {:.1f}s".format(
+            sum(r['count'] for r in results), len(results),
+            sum(r['total'] + r['fetch'] for r in results), time.time() - self.started)]
+        lines.append("{:>9} {:>9} {:>8} {:>8} {:>10}  {}".format('count', 'total', 'p95', 'max', 'rows', 'statement'))
+        for r in results[:self.top]:
+            lines.append("{:>9} {:>8.2f}s {:>7.3f}s {:>7.3f}s {:>10}  {}{}".format(
+                r['count'], r['total'] + r['fetch'], r['p95'], r['max'], r['rows'],
+                r['fingerprint'][:100], ' [EXPLAIN]' if r['explain'] else ''))
+        return '\n'.join(lines)
+
+    def write(self):
+        """
+        Write the full report as JSON, if an output file was given.
+        """
+        if not self.output:
+            return
+        with open(self.output, 'w') as f:
+            json.dump({
+                'started_at': self.started,
+                'finished_at': time.time(),
+                'threshold': self.threshold,
+                'statements': self.results(),
+            }, f, indent=2, default=unicode)
+
+    def close(self):
+        if self._explain_db is not None:
+            self._explain_db.close()
+            self._explain_db = None
+
+
+class ProfiledConnection(object):
+    """
+    Stands in for a MySQLdb connection, handing out profiled cursors.
+    """
+    def __init__(self, conn, profiler):
+        self._conn = conn
+        self._profiler = profiler
+
+    def cursor(self, *args, **kwargs):
+        return ProfiledCursor(self._conn.cursor(*args, **kwargs), self._profiler)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ProfiledCursor(object):
+    """
+    Stands in for a MySQLdb cursor, timing execute and executemany and,
+    for streaming cursors, the fetches that follow.
+    """
+    def __init__(self, cursor, profiler):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._fp = None
+        # Streaming cursors don't know their row count until everything
+        # has been read, and most of their time goes into the fetches
+        self._streaming = any(k.__name__ == 'CursorUseResultMixIn' for k in type(cursor).__mro__)
+
+    def execute(self, sql, args=None):
+        start = time.time()
+        result = self._cursor.execute(sql, args)
+        seconds = time.time() - start
+        rows = 0 if self._streaming else self._cursor.rowcount
+        self._fp = self._profiler.record(sql, seconds, rows, getattr(self._cursor, '_last_executed', None) or (None if args else sql))
+        return result
+
+    def executemany(self, sql, args):
+        start = time.time()
+        result = self._cursor.executemany(sql, args)
+        self._fp = self._profiler.record(sql, time.time() - start, self._cursor.rowcount)
+        return result
+
+    def _fetch(self, method, *args):
+        if not self._streaming:
+            return method(*args)
+        start = time.time()
+        result = method(*args)
+        if result is None:
+            rows = 0
+        elif isinstance(result, (list, tuple)) and method.__name__ != 'fetchone':
+            rows = len(result)
+        else:
+            rows = 1
+        self._profiler.record_fetch(self._fp, time.time() - start, rows)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python2.7
+
+# user_directory.py
+#
+# Resolves github.com logins to the local users ghe-migrator created for
+# them, and local logins to user ids. Rather than looking each login up
+# as it comes along, the mappings for the whole migration are loaded in
+# one query the first time any login is needed and anything that isn't
+# found there is looked up in batches.
+
+
+class UserDirectory(object):
+    """
+    Per-migration lookup of github.com and local user accounts.
+
+    Logins are case insensitive on both github.com and GitHub Enterprise,
+    so everything is keyed on the lower case login.
+    """
+    batch_size = 500
+
+    def __init__(self, db, guids):
+        self.db = db
+        self.guids = list(guids)
+        # github.com login -> (local id, local login), or None when the
+        # user isn't part of the migration
+        self._github = {}
+        # local login -> local id, or None when there is no such user
+        self._local = {}
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+        # What -> github.com login -> ids of the things that were left out
+        # because the login has no local account
+        self._skipped = {}
+
+    def load(self):
+        """
+        Load every user mapped by the migrations along with the local
+        account it was mapped to. A user that's part of more than one
+        migration only ends up in the directory once.
+        """
+        self.loaded = True
+        c = self.db.cursor()
+        c.execute("""SELECT DISTINCT mr.source_url, mr.model_id, u.login FROM migratable_resources mr
+LEFT OUTER JOIN users AS u ON u.id=mr.model_id
+WHERE mr.guid IN ({}) AND mr.model_name='user'""".format(', '.join(['%s'] * len(self.guids))), self.guids)
+        for source_url, model_id, login in c.fetchall():
+            self._add_mapping(source_url, model_id, login)
+        c.close()
+
+    def _add_mapping(self, source_url, model_id, login):
+        github_login = source_url.rsplit('/', 1)[-1].lower()
+        self._github[github_login] = (model_id, login)
+        if login:
+            self._local[login.lower()] = model_id
+
+    def _batches(self, items):
+        items = list(items)
+        for i in xrange(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    def resolve_github(self, logins):
+        """
+        Make sure the given github.com logins have been looked up, using
+        batched queries for any that weren't in the initial load.
+
+        Arguments:
+            logins (iterable): github.com logins
+        """
+        if not self.loaded:
+            self.load()
+        missing = set(l.lower() for l in logins) - set(self._github)
+        if not missing:
+            return
+        c = self.db.cursor()
+        for batch in self._batches(missing):
+            c.execute("""SELECT DISTINCT mr.source_url, mr.model_id, u.login FROM migratable_resources mr
+LEFT OUTER JOIN users AS u ON u.id=mr.model_id
+WHERE mr.guid IN ({}) AND mr.source_url IN ({})""".format(', '.join(['%s'] * len(self.guids)),
+                                                         ', '.join(['%s'] * len(batch))),
+                      self.guids + ['https://github.com/{}'.format(l) for l in batch])
+            for source_url, model_id, login in c.fetchall():
+                self._add_mapping(source_url, model_id, login)
+        c.close()
+        for login in missing:
+            self._github.setdefault(login, None)
+
+    def resolve_local(self, logins):
+        """
+        Make sure the given local logins have been looked up, using batched
+        queries for any that weren't in the initial load.
+
+        Arguments:
+            logins (iterable): Local logins
+        """
+        if not self.loaded:
+            self.load()
+        missing = set(l.lower() for l in logins) - set(self._local)
+        if not missing:
+            return
+        c = self.db.cursor()
+        for batch in self._batches(missing):
+            c.execute("SELECT id, login FROM users WHERE login IN ({})".format(', '.join(['%s'] * len(batch))),
+                      batch)
+            for user_id, login in c.fetchall():
+                self._local[login.lower()] = user_id
+        c.close()
+        for login in missing:
+            self._local.setdefault(login, None)
+
+    def github_user(self, login):
+        """
+        Get the local account a github.com user was migrated to.
+
+        Arguments:
+            login (str): The github.com login
+        Returns:
+            (tuple): The local user id and login, or None if the user
+                wasn't migrated
+        """
+        if not self.loaded:
+            self.load()
+        key = login.lower()
+        if key in self._github:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.resolve_github([key])
+        return self._github[key]
+
+    def github_user_id(self, login):
+        """
+        Arguments:
+            login (str): The github.com login
+        Returns:
+            (int): The local user id, or None if the user wasn't migrated
+        """
+        user = self.github_user(login)
+        return user[0] if user else None
+
+    def local_user_id(self, login):
+        """
+        Arguments:
+            login (str): The local login
+        Returns:
+            (int): The local user id, or None if there is no such user
+        """
+        if not self.loaded:
+            self.load()
+        key = login.lower()
+        if key in self._local:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.resolve_local([key])
+        return self._local[key]
+
+    def skipped(self, login, what, item_id):
+        """
+        Note something that was left out because the github.com user it
+        belongs to has no local account. Noting the same item twice (when
+        a batch is retried, say) only counts it once.
+
+        Arguments:
+            login (str): The github.com login
+            what (str): What was left out, like "reviews"
+            item_id (int): The github.com id of the item
+        """
+        self._skipped.setdefault(what, {}).setdefault(login.lower(), set()).add(item_id)
+
+    def stats(self):
+        """
+        Returns:
+            (str): Summary of how well the directory did, and of anything
+                left out for users with no local account
+        """
+        lines = ["User lookups: {} hits, {} misses ({} github.com and {} local logins known)".format(
+            self.hits, self.misses, len(self._github), len(self._local))]
+        for what in sorted(self._skipped):
+            by_login = self._skipped[what]
+            lines.append("Skipped {} {} by github.com users with no local account: {}".format(
+                sum(len(ids) for ids in by_login.itervalues()), what, ', '.join(sorted(by_login))))
+        return '\n'.join(lines)
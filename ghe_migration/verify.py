@@ -0,0 +1,240 @@
+#!/usr/bin/env python2.7
+
+# verify.py
+#
+# Checks that a migration landed by comparing per repository totals on
+# both sides instead of clicking around in the UI. The GitHub Enterprise
+# side is a handful of GROUP BY queries over every migrated repository:
+#
+#   - reviews by state for each pull request
+#   - assignees for each issue and pull request
+#   - requested reviewers for each pull request
+#   - protected branches for each repository
+#
+# The github.com side comes either from an offline snapshot (reviews and
+# protected branches) or from the bulk issue, pull request and branch
+# listings of each repository (assignees, requested reviewers and
+# protected branches, plus reviews with --reviews at one call per pull
+# request). Only the repositories and pull requests that don't match are
+# reported, so only those need to be run again.
+
+from collections import defaultdict
+import github_data
+import json
+from progress import ApiCounter, Progress
+from queries import Queries
+from records import Review
+
+
+def _in_migrated_repos(table):
+    # Joins the repository of a table to the migrated repositories
+    return """JOIN repositories AS r ON r.id={}.repository_id
+JOIN (SELECT DISTINCT model_id FROM migratable_resources
+ WHERE guid IN (%s) AND model_name='repository') AS mr ON mr.model_id=r.id""".format(table)
+
+
+STATEMENTS = {
+    'review_states': """SELECT r.name AS repo, i.number, prr.state, COUNT(*) AS n
+FROM pull_request_reviews prr
+JOIN pull_requests AS pr ON pr.id=prr.pull_request_id
+JOIN issues AS i ON i.pull_request_id=pr.id
+{}
+GROUP BY r.name, i.number, prr.state""".format(_in_migrated_repos('pr')),
+    'assignees': """SELECT r.name AS repo, i.number, COUNT(*) AS n
+FROM assignments a
+JOIN issues AS i ON i.id=a.issue_id
+{}
+GROUP BY r.name, i.number""".format(_in_migrated_repos('i')),
+    'reviewers': """SELECT r.name AS repo, i.number, COUNT(*) AS n
+FROM review_requests rr
+JOIN pull_requests AS pr ON pr.id=rr.pull_request_id
+JOIN issues AS i ON i.pull_request_id=pr.id
+{}
+GROUP BY r.name, i.number""".format(_in_migrated_repos('pr')),
+    'protected_branches': """SELECT r.name AS repo, COUNT(pb.id) AS n
+FROM repositories r
+JOIN (SELECT DISTINCT model_id FROM migratable_resources
+ WHERE guid IN (%s) AND model_name='repository') AS mr ON mr.model_id=r.id
+LEFT OUTER JOIN protected_branches AS pb ON pb.repository_id=r.id
+GROUP BY r.name""",
+}
+
+# The numbers a snapshot has for each pull request, and the ones the
+# bulk listings have for each issue and pull request
+SNAPSHOT_METRICS = ('reviews',)
+LISTING_METRICS = ('assignees', 'reviewers')
+
+
+def _totals():
+    return {'protected_branches': 0, 'issues': defaultdict(dict)}
+
+
+def local_totals(m, guids, review_states):
+    """
+    Count up what's in the local database for every migrated repository.
+
+    Arguments:
+        m (connection): Database connection
+        guids (list): The migration GUIDs
+        review_states (dict): Review state name -> local state number
+    Returns:
+        (dict): Repository name -> totals
+    """
+    q = Queries(m, STATEMENTS)
+    state_names = dict((v, k) for k, v in review_states.iteritems())
+    totals = defaultdict(_totals)
+    for row in q.rows('protected_branches', guids):
+        totals[row['repo']]['protected_branches'] = row['n']
+    for row in q.rows('review_states', guids):
+        reviews = totals[row['repo']]['issues'][row['number']].setdefault('reviews', {})
+        reviews[state_names.get(row['state'], str(row['state']))] = row['n']
+    for name in ('assignees', 'reviewers'):
+        for row in q.rows(name, guids):
+            totals[row['repo']]['issues'][row['number']][name] = row['n']
+    return totals
+
+
+def snapshot_totals(reader, repos=None):
+    """
+    Count up the reviews and protected branches in a snapshot archive.
+
+    Arguments:
+        reader (offline_snapshot.SnapshotReader): The snapshot
+        repos (list): Only count these repositories
+    Returns:
+        (dict): Repository name -> totals. Assignees and reviewers
+            aren't in snapshots so they're left out.
+    """
+    totals = {}
+    for entry in reader.repos():
+        if repos and entry['repo'] not in repos:
+            continue
+        repo = totals[entry['repo']] = _totals()
+        for record in reader.records(entry):
+            if record['type'] == 'protection':
+                repo['protected_branches'] += 1
+            elif record['type'] == 'pr':
+                repo['issues'][record['number']]['reviews'] = _count_states(Review.from_dict(r) for r in record['reviews'])
+    return totals
+
+
+def github_totals(gh_repo, reviews=False):
+    """
+    Count up the assignees, requested reviewers and protected branches of
+    a github.com repository from its bulk listings.
+
+    Arguments:
+        gh_repo (object): GitHub repository object
+        reviews (bool): Also list the reviews of every pull request
+            updated since the review cutoff, at one call each
+    Returns:
+        (dict): Totals for the repository
+    """
+    totals = _totals()
+    totals['protected_branches'] = len(github_data.protected_branch_names(gh_repo))
+    for number, assignees in github_data.issue_assignees(gh_repo):
+        totals['issues'][number]['assignees'] = assignees
+    for gh_pr in github_data.per_page(gh_repo.pull_requests(state='all')):
+        totals['issues'][gh_pr.number]['reviewers'] = len(gh_pr.requested_reviewers or [])
+        if reviews and gh_pr.updated_at.replace(tzinfo=None) > github_data.REVIEW_CUTOFF:
+            totals['issues'][gh_pr.number]['reviews'] = _count_states(github_data.pr_reviews(gh_pr))
+    return totals
+
+
+def _count_states(reviews):
+    counts = defaultdict(int)
+    for r in reviews:
+        counts[r.state] += 1
+    return dict(counts)
+
+
+def compare(local, remote, metrics):
+    """
+    Compare the totals for one repository. A missing count is zero.
+
+    Arguments:
+        local (dict): Totals from the local database
+        remote (dict): Totals from github.com or a snapshot
+        metrics (tuple): The per issue numbers to compare
+    Returns:
+        (list): A dict for each mismatch
+    """
+    mismatches = []
+    if local['protected_branches'] != remote['protected_branches']:
+        mismatches.append({'number': None, 'what': 'protected branches',
+                           'local': local['protected_branches'], 'github': remote['protected_branches']})
+    for number in sorted(set(local['issues']) | set(remote['issues'])):
+        have = local['issues'].get(number, {})
+        want = remote['issues'].get(number, {})
+        for metric in metrics:
+            empty = {} if metric == 'reviews' else 0
+            if have.get(metric, empty) != want.get(metric, empty):
+                mismatches.append({'number': number, 'what': metric,
+                                   'local': have.get(metric, empty), 'github': want.get(metric, empty)})
+    return mismatches
+
+
+def run(mh, args):
+    """
+    Verify every migrated repository, or those named on the command line.
+
+    Arguments:
+        mh (MigrationHelper): Helper for the migration
+        args (argparse.Namespace): Parsed command line arguments
+    Returns:
+        (dict): Repository name -> list of mismatches, for the
+            repositories that have any
+    """
+    print "Counting what's in the database"
+    local = local_totals(mh.m, mh.guids, mh.review_states)
+    names = sorted(r['name'] for r in mh.get_migrated_repositories())
+    if args.repos:
+        names = [n for n in names if n in args.repos]
+
+    if args.snapshot:
+        from offline_snapshot import SnapshotReader
+        remote = snapshot_totals(SnapshotReader(args.snapshot), names)
+        remote_for = remote.get
+        metrics = SNAPSHOT_METRICS
+    else:
+        api = ApiCounter.for_session(mh.gh)
+        gh_repos = dict((r.name, r) for r in github_data.per_page(mh.gh.organization(mh.org).repositories()))
+        progress = Progress('repositories', total=len(names), api=api)
+        metrics = LISTING_METRICS + (SNAPSHOT_METRICS if args.reviews else ())
+
+        def remote_for(name):
+            progress.update()
+            if name not in gh_repos:
+                return None
+            return github_totals(gh_repos[name], args.reviews)
+
+    results = {}
+    missing = []
+    for name in names:
+        remote = remote_for(name)
+        if remote is None:
+            missing.append(name)
+            continue
+        mismatches = compare(local.get(name) or _totals(), remote, metrics)
+        if mismatches:
+            results[name] = mismatches
+    if not args.snapshot:
+        progress.finish("Done")
+
+    for name in sorted(results):
+        prs = sorted(set(m['number'] for m in results[name] if m['number'] is not None))
+        print "{}: {} mismatches{}".format(name, len(results[name]),
+                                           ", pull requests/issues {}".format(', '.join(str(n) for n in prs)) if prs else '')
+        for m in results[name]:
+            where = "#{}".format(m['number']) if m['number'] is not None else ''
+            print "  {}{} {}: local {} github.com {}".format(name, where, m['what'], m['local'], m['github'])
+    for name in missing:
+        print "{}: not found on github.com or in the snapshot".format(name)
+    print "{} of {} repositories match".format(len(names) - len(results) - len(missing), len(names))
+    if results:
+        print "To re-run just these, use --only {}".format(','.join(sorted(results)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'mismatches': results, 'missing': missing}, f, indent=2, sort_keys=True)
+    return results
@@ -0,0 +1,207 @@
+#!/usr/bin/env python2.7
+
+# work_queue.py
+#
+# A work queue in the database so that completing a migration can be
+# spread over several worker processes on several machines, each with
+# its own github.com token. The work is split into items of one phase
+# for one repository (branch protections) or for a range of its pull
+# requests (reviews), and workers take items with a lease:
+#
+#   - claiming an item is a single UPDATE that stamps it with a token
+#     unique to that claim, so two workers can never take the same item
+#   - a worker renews its lease as it goes, and stops (rolling back
+#     whatever it hasn't committed) if it finds the lease has been lost
+#   - an item whose lease runs out, because the worker died or lost its
+#     connection, can be claimed again by anyone
+#
+# Reviews are only ever added to a pull request that doesn't have any
+# yet, so an item being worked on twice doesn't write them twice.
+#
+# Workers on other machines need to reach the appliance's MySQL, for
+# example through an SSH tunnel, since they write the reviews there too.
+
+import os
+import socket
+import uuid
+from queries import Queries
+
+QUEUE_TABLE = 'ghe_migration_work'
+
+STATEMENTS = {
+    'create': """CREATE TABLE IF NOT EXISTS {} (
+id int(11) NOT NULL AUTO_INCREMENT PRIMARY KEY,
+repository_id int(11) NOT NULL,
+repository_name varchar(100) NOT NULL,
+phase varchar(32) NOT NULL,
+first_number int(11) NOT NULL DEFAULT 0,
+last_number int(11) NOT NULL DEFAULT 0,
+state varchar(16) NOT NULL DEFAULT 'pending',
+owner varchar(255) DEFAULT NULL,
+token varchar(32) DEFAULT NULL,
+lease_expires_at datetime DEFAULT NULL,
+attempts int(11) NOT NULL DEFAULT 0,
+last_error text,
+updated_at datetime NOT NULL,
+UNIQUE KEY (repository_id, phase, first_number),
+KEY (state, lease_expires_at)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8""".format(QUEUE_TABLE),
+    'enqueue': """INSERT IGNORE INTO {} (repository_id, repository_name, phase, first_number, last_number, updated_at)
+VALUES (%s, %s, %s, %s, %s, NOW())""".format(QUEUE_TABLE),
+    'claim': """UPDATE {} SET state='leased', owner=%s, token=%s, attempts=attempts+1, updated_at=NOW(),
+lease_expires_at=NOW() + INTERVAL %s SECOND
+WHERE state='pending' OR (state='leased' AND lease_expires_at<NOW() AND attempts<%s)
+ORDER BY id LIMIT 1""".format(QUEUE_TABLE),
+    # An item whose worker keeps dying (out of memory, say) never gets
+    # released, so it's given up on here once its leases run out too often
+    'fail_expired': """UPDATE {} SET state='failed', lease_expires_at=NULL, updated_at=NOW(),
+last_error=CONCAT('The lease ran out ', attempts, ' times, last held by ', IFNULL(owner, 'nobody'))
+WHERE state='leased' AND lease_expires_at<NOW() AND attempts>=%s""".format(QUEUE_TABLE),
+    'claimed': """SELECT id, repository_id, repository_name, phase, first_number, last_number, attempts
+FROM {} WHERE token=%s""".format(QUEUE_TABLE),
+    'heartbeat': """UPDATE {} SET lease_expires_at=NOW() + INTERVAL %s SECOND, updated_at=NOW()
+WHERE id=%s AND token=%s AND state='leased'""".format(QUEUE_TABLE),
+    'done': """UPDATE {} SET state='done', lease_expires_at=NULL, updated_at=NOW()
+WHERE id=%s AND token=%s""".format(QUEUE_TABLE),
+    'release': """UPDATE {} SET state=IF(attempts>=%s, 'failed', 'pending'), lease_expires_at=NULL,
+last_error=%s, updated_at=NOW()
+WHERE id=%s AND token=%s""".format(QUEUE_TABLE),
+    'status': """SELECT phase, state, COUNT(*) AS items FROM {}
+GROUP BY phase, state ORDER BY phase, state""".format(QUEUE_TABLE),
+    'repositories': "SELECT DISTINCT repository_id FROM {} ORDER BY repository_id".format(QUEUE_TABLE),
+    'exists': "SHOW TABLES LIKE '{}'".format(QUEUE_TABLE),
+}
+
+
+class LeaseLost(Exception):
+    """
+    Raised when a worker finds another worker has taken over its item.
+    """
+    pass
+
+
+class WorkQueue(object):
+    """
+    The queue, seen from one worker. It needs a connection of its own so
+    that claiming items and renewing leases commit straight away without
+    committing any of the worker's migration writes along with them.
+    """
+    def __init__(self, m, lease_seconds=600, max_attempts=5):
+        """
+        Arguments:
+            m (connection): Database connection used only for the queue
+            lease_seconds (int): How long a claim lasts without a heartbeat
+            max_attempts (int): Give up on an item after this many claims
+        """
+        self.m = m
+        self.q = Queries(m, STATEMENTS)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    def create(self):
+        self.q.run('create')
+        self.m.commit()
+
+    def exists(self):
+        return self.q.value('exists') is not None
+
+    def enqueue(self, repos, prs_per_item=100):
+        """
+        Add the work for some repositories. Work that's already queued
+        (done or not) is left alone, so this can be run again after more
+        repositories have been imported.
+
+        Arguments:
+            repos (list): (id, name, pull request numbers) for each repository
+            prs_per_item (int): How many pull requests go in a reviews item
+        Returns:
+            (int): The number of items added
+        """
+        rows = []
+        for repo_id, name, numbers in repos:
+            rows.append((repo_id, name, 'protection', 0, 0))
+            numbers = sorted(numbers)
+            for i in xrange(0, len(numbers), prs_per_item):
+                chunk = numbers[i:i + prs_per_item]
+                rows.append((repo_id, name, 'reviews', chunk[0], chunk[-1]))
+        self.q.c.executemany(STATEMENTS['enqueue'], rows)
+        added = self.q.c.rowcount
+        self.m.commit()
+        return added
+
+    def claim(self):
+        """
+        Take the next item that's pending or whose lease has run out.
+        Items whose leases have run out max_attempts times are marked
+        failed instead.
+
+        Returns:
+            (dict): The item, or None if there's nothing to do
+        """
+        token = uuid.uuid4().hex
+        self.q.run('fail_expired', self.max_attempts)
+        claimed = self.q.run('claim', self.owner, token, self.lease_seconds, self.max_attempts)
+        self.m.commit()
+        if not claimed:
+            return None
+        item = self.q.row('claimed', token)
+        item['token'] = token
+        return item
+
+    def heartbeat(self, item):
+        """
+        Renew the lease on an item.
+
+        Arguments:
+            item (dict): The claimed item
+        Raises:
+            LeaseLost: If the lease ran out and someone else took the item
+        """
+        renewed = self.q.run('heartbeat', self.lease_seconds, item['id'], item['token'])
+        self.m.commit()
+        if not renewed:
+            raise LeaseLost("Lost the lease on work item {}".format(item['id']))
+
+    def done(self, item):
+        """
+        Mark an item as done.
+
+        Arguments:
+            item (dict): The claimed item
+        Raises:
+            LeaseLost: If the lease ran out and someone else took the item
+        """
+        finished = self.q.run('done', item['id'], item['token'])
+        self.m.commit()
+        if not finished:
+            raise LeaseLost("Lost the lease on work item {} before finishing it".format(item['id']))
+
+    def release(self, item, error):
+        """
+        Give an item back after a failure, so it can be tried again up to
+        max_attempts times.
+
+        Arguments:
+            item (dict): The claimed item
+            error (str): What went wrong
+        """
+        self.q.run('release', self.max_attempts, error, item['id'], item['token'])
+        self.m.commit()
+
+    def repositories(self):
+        """
+        Returns:
+            (list): The ids of the repositories with work in the queue
+        """
+        return self.q.column('repositories')
+
+    def status(self):
+        """
+        Returns:
+            (list): The phase, state and number of items for each
+                combination there is
+        """
+        if not self.exists():
+            return []
+        return self.q.rows('status')